@@ -0,0 +1,277 @@
+"""
+検証パイプラインのローカルベンチマーク
+対象: proofread / check_specificity / check_trend_keywords / validate_draft（qr_generate.py）
+
+合成した日本語ドラフト（通常 140〜280字 / 長文 1,000〜1,500字）と、
+件数を指定できる禁止ワード・トレンドKWリストで計測し、
+drafts/sec・p50/p99レイテンシ・1呼び出しあたりのピークメモリ（呼び出し中に確保された量の最大値）を出力する。
+
+使い方（lambda/ ディレクトリで実行）:
+    python benchmarks/bench_validation.py
+    python benchmarks/bench_validation.py --forbidden-words 500 --keywords 2000
+    python benchmarks/bench_validation.py --save-baseline      # 現在のコミットで基準値を保存
+    python benchmarks/bench_validation.py --compare            # 最新の基準値と比較（劣化時は終了コード1）
+"""
+
+import argparse
+import copy
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import DEFAULT_STYLE  # noqa: E402
+from qr_generate import (  # noqa: E402
+    proofread,
+    check_specificity,
+    check_trend_keywords,
+    validate_draft,
+    SCORE_ASSESSMENT_KEYS,
+)
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+SIZES = {
+    "normal": (140, 280),
+    "long": (1000, 1500),
+}
+
+# 合成コーパスの素材（実際のドラフトに近い語彙・語尾・数字表現）
+FRAGMENTS = [
+    "俺は会社員時代に月収20万円で止まっていた。",
+    "結局、行動した人間だけが景色を変えられる。",
+    "3ヶ月で100人に会ってわかったことがある。",
+    "お前さんが今やるべきことは、完璧な準備じゃない。",
+    "年商1億の経営者ほど、朝の30分を大切にしている。",
+    "自分の時間を切り売りしている限り、天井は決まっている。",
+    "小さく始めて、速く直す。これだけで結果は変わる。",
+    "副業で5万円稼いだ日のことは、今でも覚えている。",
+    "AIを使う側に回るか、使われる側に回るか。",
+    "毎日1時間の積み上げが、1年後に圧倒的な差になる。",
+    "失敗は恥ずかしいことじゃない。止まることが一番の損失だ。",
+    "数字で語れる人間は、どこに行っても信頼される。",
+]
+LINE_BREAK_RATE = 0.3
+KANJI_POOL = "事業収益価値行動習慣戦略市場顧客信頼成長挑戦継続判断集中"
+
+
+def synthetic_draft(rng: random.Random, size: str) -> dict:
+    """指定サイズの合成ドラフト（AI自己採点付き）"""
+    low, high = SIZES[size]
+    target = rng.randint(low, high)
+    parts = []
+    length = 0
+    while length < target:
+        fragment = rng.choice(FRAGMENTS)
+        parts.append(fragment)
+        length += len(fragment)
+        if rng.random() < LINE_BREAK_RATE:
+            parts.append("\n")
+            length += 1
+    text = "".join(parts)[:target]
+    return {
+        "type": rng.choice(["リスペクト型", "逆説型", "発展型"]),
+        "text": text,
+        "hook_type": "共感",
+        "structure": "結論先出し",
+        "emotion_flow": "共感→気づき→行動意欲",
+        "score_self_assessment": {key: rng.randint(5, 10) for key in SCORE_ASSESSMENT_KEYS if key != "total"},
+    }
+
+
+def synthetic_words(rng: random.Random, count: int, prefix: str) -> list[str]:
+    """件数指定の合成語リスト（一部はコーパス中に出現する語を含める）"""
+    words = []
+    for i in range(count):
+        length = rng.randint(2, 5)
+        words.append(prefix + "".join(rng.choice(KANJI_POOL) for _ in range(length)) + str(i))
+    # ヒットする語も混ぜる
+    words[: min(count, 5)] = ["行動", "月収", "AI", "副業", "習慣"][: min(count, 5)]
+    return words
+
+
+def build_corpus(seed: int, drafts_per_size: int) -> dict[str, list[dict]]:
+    rng = random.Random(seed)
+    return {size: [synthetic_draft(rng, size) for _ in range(drafts_per_size)] for size in SIZES}
+
+
+def measure(func, inputs: list, repeat: int) -> dict:
+    """1呼び出しごとのレイテンシと、tracemalloc による呼び出し中のピークメモリを計測"""
+    # ウォームアップ（キャッシュ済みマッチャーの構築などを計測から除く）
+    for item in inputs[: min(len(inputs), 5)]:
+        func(item)
+
+    latencies = []
+    for _ in range(repeat):
+        for item in inputs:
+            start = time.perf_counter()
+            func(item)
+            latencies.append(time.perf_counter() - start)
+
+    # 呼び出し後に解放される一時オブジェクトも含めるため、終了時の差分ではなく呼び出し中のピークを取る
+    peaks = []
+    tracemalloc.start()
+    for item in inputs:
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        func(item)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        "calls": len(latencies),
+        "per_sec": round(len(latencies) / total, 1) if total else 0.0,
+        "p50_us": round(statistics.median(latencies) * 1e6, 1),
+        "p99_us": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6, 1),
+        "peak_bytes_per_call": round(statistics.mean(peaks)),
+    }
+
+
+def run(args) -> dict:
+    corpus = build_corpus(args.seed, args.drafts)
+    rng = random.Random(args.seed + 1)
+    style = dict(DEFAULT_STYLE)
+    style["forbidden_words"] = DEFAULT_STYLE["forbidden_words"] + synthetic_words(rng, args.forbidden_words, "禁")
+    keywords = synthetic_words(rng, args.keywords, "")
+
+    results = {}
+    for size, drafts in corpus.items():
+        texts = [draft["text"] for draft in drafts]
+        results[size] = {
+            "proofread": measure(lambda text: proofread(text, style), texts, args.repeat),
+            "check_specificity": measure(check_specificity, texts, args.repeat),
+            "check_trend_keywords": measure(lambda text: check_trend_keywords(text, keywords), texts, args.repeat),
+            # validate_draft は自己採点を書き換えるため毎回コピーを渡す
+            "validate_draft": measure(
+                lambda draft: validate_draft(copy.deepcopy(draft), keywords), drafts, args.repeat,
+            ),
+        }
+
+    return {
+        "commit": current_commit(),
+        "recorded_at": datetime.utcnow().isoformat(),
+        "python": sys.version.split()[0],
+        "params": {
+            "seed": args.seed,
+            "drafts": args.drafts,
+            "repeat": args.repeat,
+            "forbidden_words": args.forbidden_words,
+            "keywords": args.keywords,
+        },
+        "results": results,
+    }
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def baseline_path(commit: str) -> str:
+    return os.path.join(BASELINE_DIR, f"validation_{commit}.json")
+
+
+def latest_baseline() -> str | None:
+    if not os.path.isdir(BASELINE_DIR):
+        return None
+    paths = [os.path.join(BASELINE_DIR, name) for name in os.listdir(BASELINE_DIR) if name.endswith(".json")]
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list[str]:
+    """p50 かピークメモリが threshold（割合）以上悪化した項目を返す（外れ値に左右される rate は参考表示のみ）"""
+    regressions = []
+    for size, funcs in report["results"].items():
+        for name, current in funcs.items():
+            previous = baseline["results"].get(size, {}).get(name)
+            if not previous:
+                continue
+            p50_change = (current["p50_us"] - previous["p50_us"]) / previous["p50_us"] if previous["p50_us"] else 0
+            line = (
+                f"{size:6} {name:22} p50 {previous['p50_us']:>9.1f} -> {current['p50_us']:>9.1f} us "
+                f"({p50_change:+.1%})  rate {previous['per_sec']:>9.1f} -> {current['per_sec']:>9.1f}/s"
+            )
+            # ピークメモリを記録していない古い基準値とは比較しない
+            peak_change = 0
+            if previous.get("peak_bytes_per_call"):
+                peak_change = (
+                    current["peak_bytes_per_call"] - previous["peak_bytes_per_call"]
+                ) / previous["peak_bytes_per_call"]
+                line += (
+                    f"  peak {previous['peak_bytes_per_call']:>8} -> {current['peak_bytes_per_call']:>8} B"
+                    f" ({peak_change:+.1%})"
+                )
+            print(line)
+            if p50_change > threshold or peak_change > threshold:
+                regressions.append(line)
+    return regressions
+
+
+def print_report(report: dict) -> None:
+    print(f"commit {report['commit']}  params {json.dumps(report['params'])}")
+    print(f"{'size':6} {'function':22} {'calls/s':>10} {'p50(us)':>10} {'p99(us)':>10} {'peak B/call':>12}")
+    for size, funcs in report["results"].items():
+        for name, stats in funcs.items():
+            print(
+                f"{size:6} {name:22} {stats['per_sec']:>10.1f} {stats['p50_us']:>10.1f} "
+                f"{stats['p99_us']:>10.1f} {stats['peak_bytes_per_call']:>12}"
+            )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="検証パイプラインのベンチマーク")
+    parser.add_argument("--drafts", type=int, default=200, help="サイズごとの合成ドラフト数")
+    parser.add_argument("--repeat", type=int, default=5, help="計測の繰り返し回数")
+    parser.add_argument("--forbidden-words", type=int, default=100, help="追加する合成禁止ワード数")
+    parser.add_argument("--keywords", type=int, default=500, help="合成トレンドKW数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save-baseline", action="store_true", help="結果を基準値として保存")
+    parser.add_argument("--compare", nargs="?", const="latest", help="基準値ファイルと比較（省略時は最新）")
+    parser.add_argument("--threshold", type=float, default=0.15, help="劣化とみなす割合")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+
+    status = 0
+    if args.compare:
+        path = latest_baseline() if args.compare == "latest" else args.compare
+        if not path:
+            print("No baseline found")
+            return 1
+        with open(path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("params") != report["params"]:
+            print(f"Warning: params differ from baseline {baseline.get('params')}")
+        print(f"Comparing against {path} (commit {baseline.get('commit')})")
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.threshold:.0%}")
+            status = 1
+
+    # 比較後に保存する（--compare 省略時の「最新」が今回の結果にならないように）
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = baseline_path(report["commit"])
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Baseline saved: {path}")
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,542 @@
+"""
+負荷試験・テスト用の外部サービス疑似実装（X / Claude / SQS / DynamoDB / Discord）
+
+install_fakes() で config と各ハンドラーモジュールが参照するクライアントを差し替える。
+各ハンドラーはそのまま呼び出せる。tweepy が未インストールの環境では、ハンドラーが参照する
+名前（Client / TweepyException）だけを持つ代替モジュールを登録してから読み込む。
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+import types
+from collections import defaultdict, deque
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import tweepy
+except ImportError:
+    tweepy = types.ModuleType("tweepy")
+
+    class TweepyException(Exception):
+        pass
+
+    tweepy.TweepyException = TweepyException
+    tweepy.Client = object
+    sys.modules["tweepy"] = tweepy
+
+import config  # noqa: E402
+import qr_monitor  # noqa: E402
+import qr_generate  # noqa: E402
+import qr_notify  # noqa: E402
+import qr_post  # noqa: E402
+import qr_engagement  # noqa: E402
+
+
+class InjectedError(Exception):
+    """疑似サービスが注入したエラー"""
+
+
+class Faults:
+    """サービスごとの遅延（ミリ秒）とエラー率"""
+
+    def __init__(self, latency_ms: dict[str, float], error_rate: float, time_scale: float, seed: int):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def hit(self, service: str, can_fail: bool = True) -> bool:
+        """遅延を入れ、エラーを注入する場合は True を返す"""
+        with self.lock:
+            self.calls[service] += 1
+            jitter = self.rng.uniform(0.5, 1.5)
+            fail = can_fail and self.rng.random() < self.error_rate
+            if fail:
+                self.errors[service] += 1
+        time.sleep(self.latency_ms.get(service, 0) * jitter * self.time_scale / 1000)
+        return fail
+
+
+# ──────────────────────────────────────
+# DynamoDB
+# ──────────────────────────────────────
+
+def _split_paths(expression: str, names: dict) -> list[tuple[str, int | None]]:
+    paths = []
+    for token in expression.split(","):
+        token = token.strip()
+        index = None
+        if token.endswith("]"):
+            token, _, raw = token[:-1].partition("[")
+            index = int(raw)
+        paths.append((names.get(token, token), index))
+    return paths
+
+
+def _project(item: dict, expression: str | None, names: dict) -> dict:
+    if not expression:
+        return dict(item)
+    projected = {}
+    for name, index in _split_paths(expression, names):
+        if name not in item:
+            continue
+        if index is None:
+            projected[name] = item[name]
+        elif isinstance(item[name], list) and index < len(item[name]):
+            projected.setdefault(name, []).append(item[name][index])
+    return projected
+
+
+class FakeTable:
+    def __init__(self, name: str, key_fields: tuple[str, ...], faults: Faults):
+        self.name = name
+        self.key_fields = key_fields
+        self.faults = faults
+        self.items: dict[tuple, dict] = {}
+        self.lock = threading.Lock()
+
+    def _key(self, item: dict) -> tuple:
+        return tuple(item[field] for field in self.key_fields)
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, ConsistentRead=False):
+        self.faults.hit("dynamodb", can_fail=False)
+        with self.lock:
+            item = self.items.get(self._key(Key))
+            if item is None:
+                return {}
+            return {"Item": _project(item, ProjectionExpression, ExpressionAttributeNames or {})}
+
+    def put_item(self, Item):
+        self.faults.hit("dynamodb", can_fail=False)
+        with self.lock:
+            self.items[self._key(Item)] = dict(Item)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues,
+                    ExpressionAttributeNames=None, ConditionExpression=None):
+        self.faults.hit("dynamodb", can_fail=False)
+        names = ExpressionAttributeNames or {}
+        assert UpdateExpression.startswith("SET ")
+        expression, _, removals = UpdateExpression[4:].partition(" REMOVE ")
+        with self.lock:
+            item = self.items.setdefault(self._key(Key), dict(Key))
+            for path in filter(None, removals.split(",")):
+                (name, _), = _split_paths(path, names)
+                item.pop(name, None)
+            for assignment in expression.split(","):
+                path, _, operand = assignment.partition("=")
+                (name, index), = _split_paths(path, names)
+                # 条件式は評価しない。加減算（#r = #r - :c）のみ対応
+                operand, sign, delta = operand.strip().partition(" - ")
+                if not sign:
+                    operand, sign, delta = operand.partition(" + ")
+                if sign:
+                    value = item[name] + ExpressionAttributeValues[delta] * (-1 if sign == " - " else 1)
+                else:
+                    value = ExpressionAttributeValues[operand]
+                if index is None:
+                    item[name] = value
+                else:
+                    item[name][index] = value
+
+    def scan(self, ProjectionExpression=None, ExpressionAttributeNames=None, ExclusiveStartKey=None, **kwargs):
+        self.faults.hit("dynamodb", can_fail=False)
+        names = ExpressionAttributeNames or {}
+        with self.lock:
+            return {"Items": [_project(item, ProjectionExpression, names) for item in self.items.values()]}
+
+    def query(self, IndexName, KeyConditionExpression, ExpressionAttributeValues,
+              FilterExpression=None, ExclusiveStartKey=None, **kwargs):
+        # 日付バケットGSI（posted_date = :d AND posted_at >= :cutoff）と
+        # 更新予定のフィルタ（:due 以前かつ未凍結）のみ対応
+        self.faults.hit("dynamodb", can_fail=False)
+        bucket = ExpressionAttributeValues[":d"]
+        cutoff = ExpressionAttributeValues[":cutoff"]
+        due = ExpressionAttributeValues.get(":due") if FilterExpression else None
+        with self.lock:
+            return {"Items": [
+                dict(item) for item in self.items.values()
+                if item.get("posted_date") == bucket and item.get("posted_at", "") >= cutoff
+                and (due is None or (
+                    "refresh_frozen" not in item and item.get("next_refresh_at", "") <= due
+                ))
+            ]}
+
+
+class FakeDynamoDB:
+    def __init__(self, faults: Faults):
+        self.faults = faults
+        self.tables = {
+            "QuoteRepost_ProcessedPosts": FakeTable("QuoteRepost_ProcessedPosts", ("post_id",), faults),
+            "QuoteRepost_AccountProfiles": FakeTable("QuoteRepost_AccountProfiles", ("account_id",), faults),
+            "QuoteRepost_TrendKeywords": FakeTable("QuoteRepost_TrendKeywords", ("keyword",), faults),
+            "QuoteRepost_PostHistory": FakeTable("QuoteRepost_PostHistory", ("post_id", "posted_at"), faults),
+            "QuoteRepost_GenerationCache": FakeTable("QuoteRepost_GenerationCache", ("cache_key",), faults),
+            # レスポンスヘッダーを返さないためレート制限は常に未観測（ガバナーは素通し）
+            "QuoteRepost_RateLimits": FakeTable("QuoteRepost_RateLimits", ("endpoint",), faults),
+        }
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems):
+        self.faults.hit("dynamodb", can_fail=False)
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.tables[name]
+            with table.lock:
+                responses[name] = [
+                    _project(table.items[table._key(key)], request.get("ProjectionExpression"), {})
+                    for key in request["Keys"]
+                    if table._key(key) in table.items
+                ]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+    def batch_write_item(self, RequestItems):
+        # エラー注入時は一部を UnprocessedItems として返す
+        unprocessed = {}
+        for name, requests in RequestItems.items():
+            table = self.tables[name]
+            for request in requests:
+                if self.faults.hit("dynamodb_batch"):
+                    unprocessed.setdefault(name, []).append(request)
+                    continue
+                item = request["PutRequest"]["Item"]
+                with table.lock:
+                    table.items[table._key(item)] = dict(item)
+        return {"UnprocessedItems": unprocessed}
+
+
+# ──────────────────────────────────────
+# SQS / Lambda / SSM
+# ──────────────────────────────────────
+
+class FakeSQS:
+    def __init__(self, faults: Faults):
+        self.faults = faults
+        self.queue: deque = deque()
+        self.enqueued_at: dict[str, float] = {}
+        # SenderFault で拒否する post_id（不正なメッセージの再現用）
+        self.poison: set[str] = set()
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def _enqueue(self, body: str) -> None:
+        with self.lock:
+            self.next_id += 1
+            message_id = f"m{self.next_id}"
+            self.queue.append({"messageId": message_id, "body": body, "receive_count": 0})
+            post_id = json.loads(body)["post_id"]
+            self.enqueued_at.setdefault(post_id, time.perf_counter())
+
+    def send_message(self, QueueUrl, MessageBody):
+        if self.faults.hit("sqs"):
+            raise InjectedError("SQS send_message failed")
+        self._enqueue(MessageBody)
+        return {"MessageId": "ok"}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.faults.hit("sqs", can_fail=False)
+        successful, failed = [], []
+        for entry in Entries:
+            if json.loads(entry["MessageBody"])["post_id"] in self.poison:
+                failed.append({"Id": entry["Id"], "SenderFault": True, "Code": "InvalidMessageContents"})
+            elif self.faults.rng.random() < self.faults.error_rate:
+                failed.append({"Id": entry["Id"], "SenderFault": False, "Code": "InjectedError"})
+            else:
+                self._enqueue(entry["MessageBody"])
+                successful.append({"Id": entry["Id"]})
+        return {"Successful": successful, "Failed": failed}
+
+    def receive_batch(self, max_messages: int = 10) -> list[dict]:
+        with self.lock:
+            batch = [self.queue.popleft() for _ in range(min(max_messages, len(self.queue)))]
+        for record in batch:
+            record["receive_count"] += 1
+        return batch
+
+    def requeue(self, record: dict) -> None:
+        with self.lock:
+            self.queue.append(record)
+
+    def depth(self) -> int:
+        return len(self.queue)
+
+
+class FakeLambda:
+    def __init__(self, faults: Faults):
+        self.faults = faults
+        self.invocations: deque = deque()
+        self.lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.faults.hit("lambda_invoke", can_fail=False)
+        with self.lock:
+            self.invocations.append((FunctionName, json.loads(Payload)))
+        return {"StatusCode": 202}
+
+
+class FakeSSM:
+    def get_parameter(self, Name, WithDecryption=False):
+        return {"Parameter": {"Value": f"fake-{Name.rsplit('/', 1)[-1]}"}}
+
+
+# ──────────────────────────────────────
+# X API（tweepy.Client 相当）
+# ──────────────────────────────────────
+
+FRAGMENTS = [
+    "結局、行動量がすべてを解決する。", "月収100万円を超えた人の共通点は3つある。",
+    "AIを使う側に回れ。", "会社に依存しない生き方を選んだ。", "朝の1時間で人生は変わる。",
+    "失敗の数だけ経験値が貯まる。", "副業は最初の3ヶ月が勝負。", "信頼は小さな約束の積み重ね。",
+    "発信を続けた人だけが見つけてもらえる。", "数字で語れる人は強い。",
+]
+
+
+class FakeXWorld:
+    """監視アカウントのタイムラインと投稿・指標を保持する疑似X"""
+
+    def __init__(self, faults: Faults, post_rate: float, seed: int):
+        self.faults = faults
+        self.post_rate = post_rate
+        self.rng = random.Random(seed)
+        self.timelines: dict[str, list] = defaultdict(list)
+        self.tweets: dict[str, SimpleNamespace] = {}
+        self.next_id = 10 ** 18
+        self.lock = threading.Lock()
+
+    def _new_tweet(self, text: str) -> SimpleNamespace:
+        with self.lock:
+            self.next_id += self.rng.randint(1, 1000)
+            tweet = SimpleNamespace(
+                id=self.next_id,
+                text=text,
+                created_at=datetime.utcnow(),
+                public_metrics={"like_count": 0, "retweet_count": 0, "reply_count": 0,
+                                "bookmark_count": 0, "impression_count": 0},
+            )
+            self.tweets[str(tweet.id)] = tweet
+            return tweet
+
+    def advance(self, user_ids: list[str]) -> int:
+        """各アカウントが確率 post_rate で新規ポストする"""
+        posted = 0
+        for user_id in user_ids:
+            if self.rng.random() < self.post_rate:
+                text = "".join(self.rng.sample(FRAGMENTS, 4)) + f" #{self.rng.randint(0, 10 ** 6)}"
+                self.timelines[user_id].append(self._new_tweet(text))
+                posted += 1
+        for tweet in self.tweets.values():
+            metrics = tweet.public_metrics
+            metrics["impression_count"] += self.rng.randint(0, 500)
+            metrics["like_count"] += self.rng.randint(0, 10)
+        return posted
+
+    def client(self) -> "FakeXClient":
+        return FakeXClient(self)
+
+
+class FakeXClient:
+    def __init__(self, world: FakeXWorld):
+        self.world = world
+
+    def _maybe_fail(self):
+        if self.world.faults.hit("x_api"):
+            raise tweepy.TweepyException("Injected X API error")
+
+    def get_users_tweets(self, id, max_results=10, since_id=None, pagination_token=None, **kwargs):
+        self._maybe_fail()
+        timeline = [t for t in reversed(self.world.timelines[id]) if not since_id or t.id > int(since_id)]
+        offset = int(pagination_token or 0)
+        page = timeline[offset:offset + max_results]
+        meta = {"result_count": len(page)}
+        if offset + max_results < len(timeline):
+            meta["next_token"] = str(offset + max_results)
+        return SimpleNamespace(data=page or None, meta=meta)
+
+    def get_tweets(self, ids, **kwargs):
+        self._maybe_fail()
+        return SimpleNamespace(data=[self.world.tweets[i] for i in ids if i in self.world.tweets] or None)
+
+    def create_tweet(self, text, quote_tweet_id=None):
+        self._maybe_fail()
+        tweet = self.world._new_tweet(text)
+        return SimpleNamespace(data={"id": str(tweet.id), "text": text})
+
+
+# ──────────────────────────────────────
+# Claude（anthropic.Anthropic 相当）
+# ──────────────────────────────────────
+
+def _fake_drafts(request: dict, rng: random.Random) -> dict:
+    long_mode = "長文モード" in request["system"][0]["text"]
+    count = 1 if "修正対象の案" in request["messages"][0]["content"][-1]["text"] else 3
+    length = 1200 if long_mode else 200
+    drafts = []
+    for i in range(count):
+        text = ""
+        while len(text) < length:
+            text += rng.choice(FRAGMENTS) + "\n"
+        drafts.append({
+            "type": ["リスペクト型", "逆説型", "発展型"][i],
+            "text": text[:length],
+            "hook_type": "共感",
+            "structure": "結論先出し",
+            "emotion_flow": "共感→気づき→行動意欲",
+            "score_self_assessment": {key: rng.randint(6, 9) for key in qr_generate.SCORE_ASSESSMENT_KEYS},
+        })
+    return {"drafts": drafts}
+
+
+class FakeAnthropic:
+    def __init__(self, faults: Faults, seed: int):
+        self.faults = faults
+        self.rng = random.Random(seed)
+        self.messages = self
+
+    def _usage(self, output: str):
+        return SimpleNamespace(input_tokens=1500, output_tokens=len(output),
+                               cache_creation_input_tokens=0, cache_read_input_tokens=1200)
+
+    def create(self, tools=None, tool_choice=None, **request):
+        if self.faults.hit("claude"):
+            raise InjectedError("Injected Claude error")
+        result = _fake_drafts(request, self.rng)
+        if tools:
+            block = SimpleNamespace(type="tool_use", name=tools[0]["name"], input=result)
+            return SimpleNamespace(content=[block], usage=self._usage(json.dumps(result)))
+        text = json.dumps(result, ensure_ascii=False)
+        return SimpleNamespace(content=[SimpleNamespace(type="text", text=text)], usage=self._usage(text))
+
+    def stream(self, **request):
+        return FakeStream(self, request)
+
+
+class FakeStream:
+    def __init__(self, client: FakeAnthropic, request: dict):
+        self.client = client
+        self.request = request
+
+    def __enter__(self):
+        if self.client.faults.hit("claude"):
+            raise InjectedError("Injected Claude error")
+        self.text = json.dumps(_fake_drafts(self.request, self.client.rng), ensure_ascii=False)
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        for i in range(0, len(self.text), 40):
+            yield self.text[i:i + 40]
+
+    def get_final_message(self):
+        return SimpleNamespace(usage=self.client._usage(self.text))
+
+
+# ──────────────────────────────────────
+# Discord Webhook（requests.Session 相当）
+# ──────────────────────────────────────
+
+class FakeResponse:
+    def __init__(self, status_code: int, headers: dict | None = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.ok = 200 <= status_code < 300
+        self.text = ""
+
+    def json(self):
+        return {"retry_after": float(self.headers.get("Retry-After", 0))}
+
+
+class FakeDiscordSession:
+    def __init__(self, faults: Faults):
+        self.faults = faults
+        self.delivered = 0
+        self.payloads = []
+        self.statuses = []  # テストで先頭から返すステータスコード
+
+    def post(self, url, params=None, json=None, timeout=None):
+        if self.statuses:
+            status = self.statuses.pop(0)
+            if status != 200:
+                return FakeResponse(status, {"Retry-After": "0"})
+        elif self.faults.hit("discord"):
+            return FakeResponse(429, {"Retry-After": str(0.05 * self.faults.time_scale)})
+        self.delivered += 1
+        self.payloads.append(json)
+        return FakeResponse(200, {"X-RateLimit-Remaining": "4"})
+
+
+# ──────────────────────────────────────
+# 配線
+# ──────────────────────────────────────
+
+def install_fakes(args) -> SimpleNamespace:
+    latency = {
+        "x_api": args.x_latency_ms,
+        "claude": args.claude_latency_ms,
+        "dynamodb": args.ddb_latency_ms,
+        "dynamodb_batch": args.ddb_latency_ms / 25,
+        "sqs": args.sqs_latency_ms,
+        "lambda_invoke": args.sqs_latency_ms,
+        "discord": args.discord_latency_ms,
+    }
+    faults = Faults(latency, args.error_rate, args.time_scale, args.seed)
+    ddb = FakeDynamoDB(faults)
+    sqs = FakeSQS(faults)
+    lam = FakeLambda(faults)
+    world = FakeXWorld(faults, args.post_rate, args.seed)
+    x_client = world.client()
+    claude = FakeAnthropic(faults, args.seed)
+    discord = FakeDiscordSession(faults)
+
+    tables = {
+        "TABLE_PROCESSED": ddb.Table("QuoteRepost_ProcessedPosts"),
+        "TABLE_PROFILES": ddb.Table("QuoteRepost_AccountProfiles"),
+        "TABLE_TREND_KW": ddb.Table("QuoteRepost_TrendKeywords"),
+        "TABLE_HISTORY": ddb.Table("QuoteRepost_PostHistory"),
+        "TABLE_GEN_CACHE": ddb.Table("QuoteRepost_GenerationCache"),
+        "TABLE_RATE_LIMITS": ddb.Table("QuoteRepost_RateLimits"),
+    }
+    patches = {
+        config: {"ssm": FakeSSM(), "dynamodb": ddb, "sqs": sqs, "lambda_client": lam, **tables},
+        qr_monitor: {"get_x_client": lambda: x_client},
+        qr_generate: {"get_anthropic_client": lambda: claude, "lambda_client": lam,
+                      "TABLE_PROCESSED": tables["TABLE_PROCESSED"]},
+        qr_notify: {"get_http_session": lambda: discord, "TABLE_PROCESSED": tables["TABLE_PROCESSED"]},
+        qr_post: {"get_x_client": lambda: x_client, "sqs": sqs, "table_processed": tables["TABLE_PROCESSED"]},
+        qr_engagement: {"get_x_client": lambda: x_client, "TABLE_HISTORY": tables["TABLE_HISTORY"]},
+    }
+    for module, attributes in patches.items():
+        for name, value in attributes.items():
+            setattr(module, name, value)
+    config.invalidate_config_cache()
+    config.reset_clients()
+    config._generation_cache.clear()
+
+    # 監視アカウントとトレンドKWの初期データ
+    for i in range(args.accounts):
+        tables["TABLE_PROFILES"].items[(f"acct{i:04d}",)] = {
+            "account_id": f"acct{i:04d}",
+            "x_user_id": f"{1000 + i}",
+            "primary_theme": "副業・AI活用",
+            "thinking_pattern": "結論先出し",
+        }
+    for keyword in ["AI", "副業", "行動", "月収", "習慣"]:
+        tables["TABLE_TREND_KW"].items[(keyword,)] = {"keyword": keyword}
+
+    return SimpleNamespace(faults=faults, ddb=ddb, sqs=sqs, lam=lam, world=world,
+                           discord=discord, tables=tables)
+
+
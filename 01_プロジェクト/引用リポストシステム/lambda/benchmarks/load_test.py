@@ -0,0 +1,204 @@
+"""
+パイプライン全体の負荷試験（X / Claude / SQS / DynamoDB / Discord をローカルの疑似実装に差し替え）
+対象: qr_monitor → qr_generate → qr_notify → qr_post → qr_engagement
+
+各ハンドラーはそのまま呼び出し、config と各モジュールが参照する外部クライアントだけを
+遅延・エラー注入付きのインメモリ実装に置き換える。監視サイクルごとに
+ステージ別スループット、SQSキュー深さ、検出（SQS投入）→ Discord通知完了までの時間を出力する。
+
+使い方（lambda/ ディレクトリで実行。boto3 が必要、tweepy は未インストールでも可）:
+    python benchmarks/load_test.py --accounts 50
+    python benchmarks/load_test.py --accounts 200 --cycles 6 --error-rate 0.05 --time-scale 0.01
+"""
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from fakes import (
+    install_fakes,
+    config,
+    qr_monitor,
+    qr_generate,
+    qr_notify,
+    qr_post,
+    qr_engagement,
+)
+from config import MONITOR_CYCLE_MINUTES
+
+# ──────────────────────────────────────
+# シナリオ実行
+# ──────────────────────────────────────
+
+class StageStats:
+    def __init__(self):
+        self.invocations = 0
+        self.items = 0
+        self.seconds = 0.0
+
+    def record(self, items: int, seconds: float) -> None:
+        self.invocations += 1
+        self.items += items
+        self.seconds += seconds
+
+    def summary(self) -> dict:
+        return {
+            "invocations": self.invocations,
+            "items": self.items,
+            "seconds": round(self.seconds, 3),
+            "items_per_sec": round(self.items / self.seconds, 1) if self.seconds else 0.0,
+        }
+
+
+def timed(stats: StageStats, items: int, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        stats.record(items, time.perf_counter() - start)
+
+
+def advance_clock(env, elapsed: timedelta) -> None:
+    """監視サイクル間の経過時間を、保存済みのポーリング時刻を過去にずらして再現する"""
+    for account in env.tables["TABLE_PROFILES"].items.values():
+        for field in ("last_polled_at", "next_poll_at"):
+            if account.get(field):
+                account[field] = (datetime.fromisoformat(account[field]) - elapsed).isoformat()
+    config.invalidate_config_cache("accounts")
+
+
+def run(args) -> dict:
+    env = install_fakes(args)
+    stages = defaultdict(StageStats)
+    queue_depths = []
+    notified_at: dict[str, float] = {}
+    dead_letters = 0
+    posted = 0
+    rng = random.Random(args.seed)
+    user_ids = [f"{1000 + i}" for i in range(args.accounts)]
+
+    for cycle in range(args.cycles):
+        if cycle:
+            advance_clock(env, timedelta(minutes=MONITOR_CYCLE_MINUTES))
+        env.world.advance(user_ids)
+
+        # 1. 監視
+        timed(stages["monitor"], args.accounts, qr_monitor.lambda_handler, {}, None)
+        queue_depths.append(env.sqs.depth())
+
+        # 2. 生成（SQSバッチ10件ずつ、失敗レコードは再投入）
+        while env.sqs.depth():
+            batch = env.sqs.receive_batch(10)
+            event = {"Records": [{"messageId": r["messageId"], "body": r["body"]} for r in batch]}
+            response = timed(stages["generate"], len(batch), qr_generate.lambda_handler, event, None)
+            failed = {f["itemIdentifier"] for f in response.get("batchItemFailures", [])}
+            for record in batch:
+                if record["messageId"] not in failed:
+                    continue
+                if record["receive_count"] >= args.max_receive_count:
+                    dead_letters += 1
+                else:
+                    env.sqs.requeue(record)
+            queue_depths.append(env.sqs.depth())
+
+        # 3. 通知（非同期呼び出しを順に処理）
+        while env.lam.invocations:
+            _, payload = env.lam.invocations.popleft()
+            try:
+                timed(stages["notify"], 1, qr_notify.lambda_handler, payload, None)
+                notified_at.setdefault(payload["post_id"], time.perf_counter())
+            except RuntimeError as e:
+                print(f"notify failed: {e}")
+
+        # 4. 承認（通知済みの一部を投稿）
+        for post_id in list(notified_at):
+            item = env.tables["TABLE_PROCESSED"].items.get((post_id,), {})
+            if item.get("approved") or rng.random() >= args.approve_rate:
+                continue
+            item["approved"] = True
+            body = json.dumps({"action": "approve", "post_id": post_id, "draft_index": 0})
+            response = timed(stages["post"], 1, qr_post.lambda_handler, {"body": body}, None)
+            if response["statusCode"] == 200:
+                posted += 1
+
+        print(f"cycle {cycle + 1}/{args.cycles}: queue peak {max(queue_depths)}, notified {len(notified_at)}")
+
+    # 5. エンゲージメント収集（投稿直後の更新予定に合わせて時刻を進めた扱いにする）
+    for item in env.tables["TABLE_HISTORY"].items.values():
+        item["next_refresh_at"] = (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+    timed(stages["engagement"], len(env.tables["TABLE_HISTORY"].items), qr_engagement.lambda_handler, {}, None)
+
+    latencies = sorted(
+        notified_at[post_id] - env.sqs.enqueued_at[post_id]
+        for post_id in notified_at
+        if post_id in env.sqs.enqueued_at
+    )
+    return {
+        "params": vars(args),
+        "stages": {name: stats.summary() for name, stats in stages.items()},
+        "queue_depth": {
+            "max": max(queue_depths) if queue_depths else 0,
+            "mean": round(statistics.mean(queue_depths), 1) if queue_depths else 0,
+        },
+        "end_to_end_seconds": {
+            "count": len(latencies),
+            "p50": round(statistics.median(latencies), 3) if latencies else None,
+            "p95": round(latencies[int(len(latencies) * 0.95) - 1], 3) if latencies else None,
+            "max": round(latencies[-1], 3) if latencies else None,
+        },
+        "dead_letters": dead_letters,
+        "posted": posted,
+        "service_calls": dict(env.faults.calls),
+        "injected_errors": dict(env.faults.errors),
+        "discord_messages": env.discord.delivered,
+    }
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="パイプライン負荷試験（ローカル疑似サービス）")
+    parser.add_argument("--accounts", type=int, default=50)
+    parser.add_argument("--cycles", type=int, default=3, help="監視サイクル数")
+    parser.add_argument("--post-rate", type=float, default=0.3, help="1サイクルで各アカウントが投稿する確率")
+    parser.add_argument("--approve-rate", type=float, default=0.3, help="通知済みポストを承認する確率")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="各サービス呼び出しのエラー注入率")
+    parser.add_argument("--max-receive-count", type=int, default=3, help="DLQに送るまでの受信回数")
+    parser.add_argument("--x-latency-ms", type=float, default=300)
+    parser.add_argument("--claude-latency-ms", type=float, default=8000)
+    parser.add_argument("--ddb-latency-ms", type=float, default=8)
+    parser.add_argument("--sqs-latency-ms", type=float, default=15)
+    parser.add_argument("--discord-latency-ms", type=float, default=150)
+    parser.add_argument("--time-scale", type=float, default=0.05, help="全遅延に掛ける倍率（短時間で回すため）")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    return parser.parse_args(argv)
+
+
+def main() -> int:
+    args = parse_args()
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0
+
+    print(f"\n{'stage':12} {'invocations':>12} {'items':>8} {'seconds':>10} {'items/s':>10}")
+    for name, stats in report["stages"].items():
+        print(f"{name:12} {stats['invocations']:>12} {stats['items']:>8} {stats['seconds']:>10.3f} {stats['items_per_sec']:>10.1f}")
+    print(f"\nqueue depth: max {report['queue_depth']['max']}, mean {report['queue_depth']['mean']}")
+    e2e = report["end_to_end_seconds"]
+    print(f"detection -> Discord: n={e2e['count']} p50={e2e['p50']}s p95={e2e['p95']}s max={e2e['max']}s "
+          f"(latencies scaled by {args.time_scale})")
+    print(f"posted {report['posted']}, dead letters {report['dead_letters']}, "
+          f"discord messages {report['discord_messages']}")
+    print(f"service calls {report['service_calls']}")
+    if report["injected_errors"]:
+        print(f"injected errors {report['injected_errors']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,30 +5,316 @@ AWS SSM Parameter Store からシークレットを取得し、各Lambda関数
 
 import os
 import json
+import math
+import re
+import time
+import functools
+import threading
+from contextlib import contextmanager
 import boto3
-from functools import lru_cache
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+# HTTPコネクションプール設定（ウォームスタート間で接続を再利用する）
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY_SECONDS", "60"))
+# シークレットの再取得間隔（ローテーション検知用）
+SECRET_CACHE_TTL = int(os.environ.get("SECRET_CACHE_TTL_SECONDS", "900"))
+
+BOTO_CONFIG = Config(
+    region_name="ap-northeast-1",
+    max_pool_connections=HTTP_POOL_SIZE,
+    tcp_keepalive=True,
+    retries={"max_attempts": 3, "mode": "standard"},
+)
 
 # AWS Clients
-ssm = boto3.client("ssm", region_name="ap-northeast-1")
-dynamodb = boto3.resource("dynamodb", region_name="ap-northeast-1")
-sqs = boto3.client("sqs", region_name="ap-northeast-1")
+ssm = boto3.client("ssm", config=BOTO_CONFIG)
+dynamodb = boto3.resource("dynamodb", config=BOTO_CONFIG)
+sqs = boto3.client("sqs", config=BOTO_CONFIG)
+lambda_client = boto3.client("lambda", config=BOTO_CONFIG)
 
 # DynamoDB Tables
 TABLE_PROCESSED = dynamodb.Table("QuoteRepost_ProcessedPosts")
 TABLE_PROFILES = dynamodb.Table("QuoteRepost_AccountProfiles")
 TABLE_TREND_KW = dynamodb.Table("QuoteRepost_TrendKeywords")
 TABLE_HISTORY = dynamodb.Table("QuoteRepost_PostHistory")
+TABLE_GEN_CACHE = dynamodb.Table("QuoteRepost_GenerationCache")
+TABLE_RATE_LIMITS = dynamodb.Table("QuoteRepost_RateLimits")
+
+# 投稿日（UTC, YYYY-MM-DD）バケットで直近の投稿を引くためのGSI
+HISTORY_DATE_INDEX = "posted_date-posted_at-index"
+
+# エンゲージメント更新間隔: (投稿からの経過時間の上限[h], 更新間隔[h])
+# 最後の段階を過ぎた投稿は更新を凍結する
+ENGAGEMENT_REFRESH_TIERS = [
+    (24, 1),       # 初日は1時間ごと
+    (72, 6),       # 3日目までは6時間ごと
+    (7 * 24, 24),  # 7日目までは日次
+    (14 * 24, 72), # 14日目までは3日ごと
+]
+# 更新対象を探す期間（日）。最後の段階の境界で行う最終更新（凍結）まで拾えるよう1日余裕を持たせる
+ENGAGEMENT_WINDOW_DAYS = ENGAGEMENT_REFRESH_TIERS[-1][0] // 24 + 1
+
+# DynamoDBバッチAPIの1リクエストあたり上限
+BATCH_GET_LIMIT = 100
+BATCH_WRITE_LIMIT = 25
+BATCH_MAX_RETRIES = 5
+SQS_BATCH_LIMIT = 10
+
+# プロファイル・トレンドKWのウォームコンテナ内キャッシュ有効期間（秒）
+CONFIG_CACHE_TTL = int(os.environ.get("CONFIG_CACHE_TTL_SECONDS", "300"))
+
+# 各Lambdaが実際に参照するプロファイル項目
+PROFILE_FIELDS = (
+    "account_id",
+    "x_user_id",
+    "primary_theme",
+    "thinking_pattern",
+    "vocabulary_features",
+    "hook_style",
+    "quote_angle",
+    "best_quote_type",
+    "last_seen_tweet_id",
+    "last_observed_tweet_id",
+    "recent_fingerprints",
+    "last_polled_at",
+    "next_poll_at",
+    "poll_backoff",
+    "post_rate",
+    "avg_engagement",
+)
 
 # SQS Queue URLs
 SQS_NEW_POST_QUEUE = os.environ.get("SQS_NEW_POST_QUEUE_URL", "")
 SQS_RETRY_QUEUE = os.environ.get("SQS_RETRY_QUEUE_URL", "")
 
+# 監視アカウントのタイムライン取得の同時実行数
+MONITOR_CONCURRENCY = int(os.environ.get("MONITOR_CONCURRENCY", "8"))
+# since_id 指定時に1アカウントあたり辿る最大ページ数
+MONITOR_MAX_PAGES = int(os.environ.get("MONITOR_MAX_PAGES", "5"))
+
+# エンゲージメント取得（100件/リクエスト）の同時実行数
+ENGAGEMENT_CONCURRENCY = int(os.environ.get("ENGAGEMENT_CONCURRENCY", "4"))
+
+# 監視アカウントの適応ポーリング
+# EventBridgeの起動間隔（分）。新規ポストが無いアカウントは 2^poll_backoff サイクルごとに間引く
+MONITOR_CYCLE_MINUTES = int(os.environ.get("MONITOR_CYCLE_MINUTES", "5"))
+MONITOR_MAX_BACKOFF = int(os.environ.get("MONITOR_MAX_BACKOFF", "5"))
+# 投稿頻度×エンゲージメントの上位この割合は毎サイクルポーリングする
+MONITOR_HOT_RATIO = float(os.environ.get("MONITOR_HOT_RATIO", "0.2"))
+# 投稿頻度・平均エンゲージメントの指数移動平均の重み
+MONITOR_EWMA_ALPHA = float(os.environ.get("MONITOR_EWMA_ALPHA", "0.3"))
+# 監視状態に変化が無くても、この間隔（分）を過ぎたら last_polled_at と投稿頻度を書き込む
+MONITOR_STATE_HEARTBEAT_MINUTES = int(os.environ.get("MONITOR_STATE_HEARTBEAT_MINUTES", "60"))
+
+# 近似重複ポスト検出（SimHash）
+# ハミング距離がこの値以下なら近似重複とみなす（64bit中）
+NEAR_DUP_MAX_DISTANCE = int(os.environ.get("NEAR_DUP_MAX_DISTANCE", "3"))
+# "suppress": SQSに送らず処理済みにする / "flag": near_duplicate_of を付けて送り、Discord通知に表示する
+NEAR_DUP_ACTION = os.environ.get("NEAR_DUP_ACTION", "suppress")
+NEAR_DUP_WINDOW_DAYS = int(os.environ.get("NEAR_DUP_WINDOW_DAYS", "7"))
+NEAR_DUP_MAX_PER_ACCOUNT = int(os.environ.get("NEAR_DUP_MAX_PER_ACCOUNT", "50"))
+# 短すぎる本文はフィンガープリントが不安定なため判定しない
+NEAR_DUP_MIN_CHARS = int(os.environ.get("NEAR_DUP_MIN_CHARS", "20"))
+
+# 生成結果キャッシュ（同一入力の再配信・リトライで再生成しない）
+GENERATION_CACHE_TTL_HOURS = int(os.environ.get("GENERATION_CACHE_TTL_HOURS", "24"))
+GENERATION_CACHE_MEMORY_SIZE = int(os.environ.get("GENERATION_CACHE_MEMORY_SIZE", "128"))
+
+# SQSバッチ内のドラフト生成の同時実行数
+GENERATE_CONCURRENCY = int(os.environ.get("GENERATE_CONCURRENCY", "5"))
+# ドラフト生成方式: "stream"（逐次パース + 早期検証） / "tool"（ツールスキーマ） / "text"（一括応答）
+GENERATION_MODE = os.environ.get("GENERATION_MODE", "stream")
+
+# X APIレート制限: 優先度ごとに残しておく予約枠（ウィンドウ上限に対する割合）
+# 承認投稿（high）は予約枠を使い切れるが、監視（normal）・エンゲージメント更新（low）は残す
+X_RATE_RESERVE = {
+    "high": 0.0,
+    "normal": float(os.environ.get("X_RATE_RESERVE_NORMAL", "0.1")),
+    "low": float(os.environ.get("X_RATE_RESERVE_LOW", "0.3")),
+}
+
+# ステージ別メトリクス（CloudWatch Embedded Metric Format）の名前空間。TRACE_ENABLED=0 で出力しない
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "QuoteRepost")
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "1") != "0"
+
+
+# ──────────────────────────────────────
+# ステージ別トレース（所要時間・呼び出し数・リトライ数・トークン使用量）
+# ──────────────────────────────────────
+
+_trace_lock = threading.Lock()
+_stage_stats: dict[str, dict] = {}
+_token_usage: dict[str, int] = {}
+
+
+def _stage_entry(stage: str) -> dict:
+    return _stage_stats.setdefault(stage, {
+        "calls": 0, "errors": 0, "retries": 0, "duration_ms": 0.0, "max_ms": 0.0,
+    })
+
+
+def record_stage(stage: str, duration_ms: float, error: bool = False, retries: int = 0) -> None:
+    """1回分の呼び出しを集計（スレッドセーフ）"""
+    with _trace_lock:
+        entry = _stage_entry(stage)
+        entry["calls"] += 1
+        entry["errors"] += int(error)
+        entry["retries"] += retries
+        entry["duration_ms"] += duration_ms
+        entry["max_ms"] = max(entry["max_ms"], duration_ms)
+
+
+def record_retry(stage: str, count: int = 1) -> None:
+    """アプリ側で行った再試行（未処理アイテムの再送、429待ち等）を集計"""
+    if count <= 0:
+        return
+    with _trace_lock:
+        _stage_entry(stage)["retries"] += count
+
+
+def record_token_usage(usage: dict) -> None:
+    """Claude APIのトークン使用量（input/output/cache_*）を加算"""
+    with _trace_lock:
+        for name, value in usage.items():
+            if isinstance(value, int) and not isinstance(value, bool):
+                _token_usage[name] = _token_usage.get(name, 0) + value
+
+
+@contextmanager
+def trace_stage(stage: str):
+    """withブロックの所要時間を stage として集計（例外は errors に数えて再送出）"""
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record_stage(stage, (time.perf_counter() - start) * 1000, error=error)
+
+
+def traced(stage: str):
+    """関数呼び出しを trace_stage で計測するデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _emf_record(dimensions: dict, metrics: dict[str, tuple[float, str]]) -> str:
+    return json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [list(dimensions)],
+                "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in metrics.items()],
+            }],
+        },
+        **dimensions,
+        **{name: value for name, (value, _) in metrics.items()},
+    }, ensure_ascii=False)
+
+
+def flush_metrics(function_name: str) -> None:
+    """集計値をEMF形式で出力してリセット（ステージごとに1行 + トークン使用量1行）"""
+    with _trace_lock:
+        stages = dict(_stage_stats)
+        usage = dict(_token_usage)
+        _stage_stats.clear()
+        _token_usage.clear()
+    if not TRACE_ENABLED:
+        return
+
+    for stage, stats in sorted(stages.items()):
+        print(_emf_record({"Function": function_name, "Stage": stage}, {
+            "Duration": (round(stats["duration_ms"], 2), "Milliseconds"),
+            "MaxDuration": (round(stats["max_ms"], 2), "Milliseconds"),
+            "Calls": (stats["calls"], "Count"),
+            "Errors": (stats["errors"], "Count"),
+            "Retries": (stats["retries"], "Count"),
+        }))
+    if usage:
+        print(_emf_record({"Function": function_name}, {
+            name: (value, "Count") for name, value in sorted(usage.items())
+        }))
+
+
+def instrumented_handler(function_name: str):
+    """Lambdaハンドラー全体を計測し、終了時（例外時も）にステージ別メトリクスを出力する"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            try:
+                with trace_stage("handler"):
+                    return handler(event, context)
+            finally:
+                flush_metrics(function_name)
+                # X APIのレート制限ヘッダーも起動ごとに1回だけ書き込む
+                flush_x_rate_limits()
+        return wrapper
+    return decorator
+
+
+def _before_aws_call(model, context, **kwargs):
+    context["trace_stage"] = f"{model.service_model.service_name}.{model.name}"
+    context["trace_started"] = time.perf_counter()
+
+
+def _after_aws_call(http_response, parsed, context, **kwargs):
+    if "trace_started" not in context:
+        return
+    record_stage(
+        context["trace_stage"],
+        (time.perf_counter() - context["trace_started"]) * 1000,
+        error=http_response.status_code >= 300,
+        retries=parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+    )
+
+
+def _after_aws_call_error(context, **kwargs):
+    # 接続エラー等でレスポンスが得られなかった呼び出し
+    if "trace_started" not in context:
+        return
+    record_stage(
+        context["trace_stage"],
+        (time.perf_counter() - context["trace_started"]) * 1000,
+        error=True,
+    )
+
+
+def _instrument_aws_client(client) -> None:
+    """botocoreのイベントフックで全API呼び出し（DynamoDB/SQS等）を計測"""
+    client.meta.events.register("before-call", _before_aws_call)
+    client.meta.events.register("after-call", _after_aws_call)
+    client.meta.events.register("after-call-error", _after_aws_call_error)
+
+
+for _client in (ssm, dynamodb.meta.client, sqs, lambda_client):
+    _instrument_aws_client(_client)
+
+
+_secret_cache: dict[str, tuple[float, str]] = {}
+
 
-@lru_cache(maxsize=16)
 def get_secret(name: str) -> str:
-    """SSM Parameter Storeからシークレットを取得（キャッシュ付き）"""
+    """SSM Parameter Storeからシークレットを取得（TTL付きキャッシュ）"""
+    entry = _secret_cache.get(name)
+    now = time.monotonic()
+    if entry and entry[0] > now:
+        return entry[1]
     resp = ssm.get_parameter(Name=name, WithDecryption=True)
-    return resp["Parameter"]["Value"]
+    value = resp["Parameter"]["Value"]
+    _secret_cache[name] = (now + SECRET_CACHE_TTL, value)
+    return value
 
 
 def get_x_credentials() -> dict:
@@ -53,37 +339,587 @@ def get_discord_bot_token() -> str:
     return get_secret("/quote-repost/discord-bot-token")
 
 
+_config_cache: dict[str, tuple[float, list]] = {}
+
+
+def scan_all(table, fields: tuple[str, ...] | None = None, **kwargs) -> list[dict]:
+    """LastEvaluatedKeyを辿ってテーブル全件をスキャン（fields指定時は射影）"""
+    if fields:
+        names = {f"#f{i}": field for i, field in enumerate(fields)}
+        kwargs["ProjectionExpression"] = ", ".join(names)
+        kwargs["ExpressionAttributeNames"] = {**kwargs.get("ExpressionAttributeNames", {}), **names}
+
+    items = []
+    while True:
+        response = table.scan(**kwargs)
+        items.extend(response.get("Items", []))
+        last_key = response.get("LastEvaluatedKey")
+        if not last_key:
+            return items
+        kwargs["ExclusiveStartKey"] = last_key
+
+
+def query_all(table, **kwargs) -> list[dict]:
+    """LastEvaluatedKeyを辿ってクエリ結果を全件取得"""
+    items = []
+    while True:
+        response = table.query(**kwargs)
+        items.extend(response.get("Items", []))
+        last_key = response.get("LastEvaluatedKey")
+        if not last_key:
+            return items
+        kwargs["ExclusiveStartKey"] = last_key
+
+
+def _cached(name: str, loader):
+    entry = _config_cache.get(name)
+    now = time.monotonic()
+    if entry and entry[0] > now:
+        return entry[1]
+    value = loader()
+    _config_cache[name] = (now + CONFIG_CACHE_TTL, value)
+    return value
+
+
+def invalidate_config_cache(name: str | None = None) -> None:
+    """キャッシュを破棄（name省略時は全件）"""
+    if name is None:
+        _config_cache.clear()
+    else:
+        _config_cache.pop(name, None)
+
+
+# ──────────────────────────────────────
+# 共有APIクライアント（ウォームスタート間で再利用）
+# ──────────────────────────────────────
+
+_clients: dict[str, tuple[tuple, object]] = {}
+_clients_lock = threading.Lock()
+
+
+def _shared_client(name: str, fingerprint: tuple, factory):
+    """fingerprint（認証情報）が変わらない限り同じクライアントを返す"""
+    with _clients_lock:
+        entry = _clients.get(name)
+        if entry and entry[0] == fingerprint:
+            return entry[1]
+        client = factory()
+        _clients[name] = (fingerprint, client)
+        return client
+
+
+def reset_clients() -> None:
+    """キャッシュ済みのシークレットとクライアントを破棄（認証エラー時に call_with_reauth から呼ぶ）"""
+    with _clients_lock:
+        _clients.clear()
+    _secret_cache.clear()
+
+
+def _is_auth_error(error: Exception) -> bool:
+    """401（anthropic.AuthenticationError / tweepy.Unauthorized）か"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status == 401
+
+
+def call_with_reauth(get_client, call):
+    """call(get_client()) を実行し、401ならシークレットとクライアントを取り直して1回だけ再試行
+
+    シークレットのローテーション後も SECRET_CACHE_TTL を待たずに新しい認証情報へ切り替わる。
+    """
+    try:
+        return call(get_client())
+    except Exception as e:
+        if not _is_auth_error(e):
+            raise
+        print(f"Authentication failed ({type(e).__name__}); reloading secrets and retrying once")
+        reset_clients()
+        return call(get_client())
+
+
+def _pooled_adapter():
+    from requests.adapters import HTTPAdapter
+    return HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+
+
+def get_anthropic_client():
+    """Anthropicクライアント（keep-alive付きコネクションプール）"""
+    api_key = get_claude_api_key()
+
+    def factory():
+        import anthropic
+        import httpx
+        return anthropic.Anthropic(
+            api_key=api_key,
+            http_client=anthropic.DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_POOL_SIZE,
+                    max_keepalive_connections=HTTP_POOL_SIZE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+            ),
+        )
+
+    return _shared_client("anthropic", (api_key,), factory)
+
+
+def get_x_client():
+    """X API v2クライアント（tweepy、セッション共有）"""
+    creds = get_x_credentials()
+
+    def factory():
+        import tweepy
+        client = tweepy.Client(
+            consumer_key=creds["api_key"],
+            consumer_secret=creds["api_secret"],
+            access_token=creds["access_token"],
+            access_token_secret=creds["access_secret"],
+        )
+        client.session.mount("https://", _pooled_adapter())
+        client.session.hooks["response"].append(_observe_x_rate_limit)
+        return client
+
+    return _shared_client("tweepy", tuple(sorted(creds.items())), factory)
+
+
+def get_http_session():
+    """Discord Webhook等に使う共有requests.Session"""
+    def factory():
+        import requests
+        session = requests.Session()
+        session.mount("https://", _pooled_adapter())
+        return session
+
+    return _shared_client("http", (), factory)
+
+
+# ──────────────────────────────────────
+# X APIレート制限ガバナー（エンドポイントごとの残り回数をDynamoDBで共有）
+# ──────────────────────────────────────
+
+# (HTTPメソッド, パス) → レート制限のエンドポイント名
+X_ENDPOINTS = [
+    ("GET", re.compile(r"^/2/users/[^/]+/tweets$"), "users_tweets"),
+    ("GET", re.compile(r"^/2/tweets$"), "tweets_lookup"),
+    ("POST", re.compile(r"^/2/tweets$"), "create_tweet"),
+]
+
+
+def x_endpoint(method: str, url: str) -> str | None:
+    path = urlparse(url).path
+    for endpoint_method, pattern, name in X_ENDPOINTS:
+        if method == endpoint_method and pattern.match(path):
+            return name
+    return None
+
+
+_x_rate_observations: dict[str, tuple[int, int, int]] = {}
+_x_rate_lock = threading.Lock()
+
+
+def _observe_x_rate_limit(response, *args, **kwargs):
+    """tweepyのセッションのレスポンスフック: x-rate-limit-* ヘッダーをメモリに記録
+
+    DynamoDBへの書き込みは起動の終わりに flush_x_rate_limits でまとめて行う。
+    """
+    try:
+        headers = response.headers
+        endpoint = x_endpoint(response.request.method, response.url)
+        if endpoint is None or "x-rate-limit-remaining" not in headers:
+            return
+        observed = (
+            int(headers.get("x-rate-limit-reset", 0)),
+            int(headers["x-rate-limit-remaining"]),
+            int(headers.get("x-rate-limit-limit", 0)),
+        )
+        with _x_rate_lock:
+            latest = _x_rate_observations.get(endpoint)
+            # 新しいウィンドウ、または同一ウィンドウで残りが少ない方を採用
+            if latest is None or (observed[0], -observed[1]) > (latest[0], -latest[1]):
+                _x_rate_observations[endpoint] = observed
+    except Exception as e:
+        # 記録に失敗しても本来のAPI呼び出しは止めない
+        print(f"Failed to observe X rate limit: {e}")
+
+
+def flush_x_rate_limits() -> None:
+    """この起動中に観測した残り回数をエンドポイントごとに1回だけ保存"""
+    with _x_rate_lock:
+        observations = dict(_x_rate_observations)
+        _x_rate_observations.clear()
+    for endpoint, (reset_at, remaining, limit) in observations.items():
+        try:
+            record_x_rate_limit(endpoint, limit=limit, remaining=remaining, reset_at=reset_at)
+        except Exception as e:
+            print(f"Failed to record X rate limit for {endpoint}: {e}")
+
+
+def record_x_rate_limit(endpoint: str, limit: int, remaining: int, reset_at: int) -> None:
+    """ヘッダーで観測した残り回数を保存（同一ウィンドウ内では減る方向の更新のみ採用）"""
+    try:
+        TABLE_RATE_LIMITS.update_item(
+            Key={"endpoint": endpoint},
+            UpdateExpression="SET #l = :l, #r = :r, #t = :t, observed_at = :o",
+            ConditionExpression="attribute_not_exists(#t) OR #t < :t OR #r >= :r",
+            ExpressionAttributeNames={"#l": "limit", "#r": "remaining", "#t": "reset_at"},
+            ExpressionAttributeValues={
+                ":l": limit, ":r": remaining, ":t": reset_at,
+                ":o": datetime.utcnow().isoformat(),
+            },
+        )
+    except ClientError as e:
+        # 他の呼び出しがより新しい値を書き込み済み
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+
+
+def _x_rate_state(endpoint: str) -> dict | None:
+    """現在のウィンドウの状態（未観測・リセット済みなら None）"""
+    item = TABLE_RATE_LIMITS.get_item(Key={"endpoint": endpoint}, ConsistentRead=True).get("Item")
+    if not item or int(item.get("reset_at", 0)) <= time.time():
+        return None
+    return item
+
+
+def _reserve(item: dict, priority: str) -> int:
+    return math.ceil(int(item.get("limit", 0)) * X_RATE_RESERVE.get(priority, 0))
+
+
+def x_rate_budget(endpoint: str, priority: str = "normal") -> int | None:
+    """優先度の予約枠を除いて今使える残り回数（制限が未観測・リセット済みなら None）"""
+    item = _x_rate_state(endpoint)
+    if item is None:
+        return None
+    return max(0, int(item["remaining"]) - _reserve(item, priority))
+
+
+def _take_x_budget(endpoint: str, cost: int, priority: str) -> int | None | bool:
+    """残り回数から cost 分を差し引く
+
+    差し引いたウィンドウのリセット時刻、制限が未観測なら None、予約枠を割り込むなら False を返す。
+    """
+    item = _x_rate_state(endpoint)
+    if item is None:
+        return None
+    try:
+        TABLE_RATE_LIMITS.update_item(
+            Key={"endpoint": endpoint},
+            UpdateExpression="SET #r = #r - :c",
+            ConditionExpression="#t <= :now OR #r >= :need",
+            ExpressionAttributeNames={"#r": "remaining", "#t": "reset_at"},
+            ExpressionAttributeValues={
+                ":c": cost,
+                ":need": cost + _reserve(item, priority),
+                ":now": int(time.time()),
+            },
+        )
+        return int(item["reset_at"])
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        print(f"X API budget exhausted for {endpoint} ({priority}), resets at {item['reset_at']}")
+        return False
+
+
+def acquire_x_budget(endpoint: str, cost: int = 1, priority: str = "normal") -> bool:
+    """残り回数から cost 分を確保する（予約枠を割り込む場合は False）
+
+    確保した分はレスポンスヘッダーの観測値で上書きされるため、厳密な消費数でなくてよい。
+    """
+    return _take_x_budget(endpoint, cost, priority) is not False
+
+
+class XBudget:
+    """1回の起動で使う呼び出し回数を最大見込みでまとめて確保し、使わなかった分を返却する
+
+    reserve → 呼び出しごとに take → 最後に release。ページ数が事前に分からない取得向け。
+    """
+
+    def __init__(self, endpoint: str, priority: str = "normal"):
+        self.endpoint = endpoint
+        self.priority = priority
+        self.unlimited = False
+        self.allowance = 0
+        self.reset_at = None
+        self._lock = threading.Lock()
+
+    def reserve(self, cost: int) -> bool:
+        result = _take_x_budget(self.endpoint, cost, self.priority)
+        if result is False:
+            return False
+        if result is None:
+            self.unlimited = True
+        else:
+            self.allowance += cost
+            self.reset_at = result
+        return True
+
+    def take(self, count: int = 1) -> bool:
+        """確保済みの枠から count 回分を使う（枠が無ければ False）"""
+        with self._lock:
+            if self.unlimited:
+                return True
+            if self.allowance < count:
+                return False
+            self.allowance -= count
+            return True
+
+    def release(self) -> None:
+        """使わなかった枠を同じウィンドウに返却"""
+        with self._lock:
+            unused, self.allowance = self.allowance, 0
+        if not unused or self.reset_at is None:
+            return
+        try:
+            TABLE_RATE_LIMITS.update_item(
+                Key={"endpoint": self.endpoint},
+                UpdateExpression="SET #r = #r + :c",
+                ConditionExpression="#t = :t",
+                ExpressionAttributeNames={"#r": "remaining", "#t": "reset_at"},
+                ExpressionAttributeValues={":c": unused, ":t": self.reset_at},
+            )
+        except ClientError as e:
+            # ウィンドウがリセット済みなら返却は不要
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+
+def x_rate_reset_at(endpoint: str) -> int | None:
+    """現在のウィンドウのリセット時刻（UNIX秒）"""
+    item = _x_rate_state(endpoint)
+    return int(item["reset_at"]) if item else None
+
+
 def get_monitored_accounts() -> list[dict]:
-    """DynamoDBから監視対象アカウント一覧を取得"""
-    response = TABLE_PROFILES.scan()
-    return response.get("Items", [])
+    """DynamoDBから監視対象アカウント一覧を取得（TTL付きキャッシュ）"""
+    return _cached("accounts", lambda: scan_all(TABLE_PROFILES, PROFILE_FIELDS))
+
+
+def update_account_state(account_id: str, **fields) -> None:
+    """アカウントの監視状態（since_id用ウォーターマーク、近似重複用フィンガープリント等）を更新"""
+    fields["last_polled_at"] = datetime.utcnow().isoformat()
+    items = list(fields.items())
+    TABLE_PROFILES.update_item(
+        Key={"account_id": account_id},
+        UpdateExpression="SET " + ", ".join(f"#f{i} = :v{i}" for i in range(len(items))),
+        ExpressionAttributeNames={f"#f{i}": name for i, (name, _) in enumerate(items)},
+        ExpressionAttributeValues={f":v{i}": value for i, (_, value) in enumerate(items)},
+    )
+    # キャッシュ済みプロファイルにも反映し、次回起動で古い状態を使わないようにする
+    entry = _config_cache.get("accounts")
+    if entry:
+        for account in entry[1]:
+            if account.get("account_id") == account_id:
+                account.update(fields)
 
 
 def get_trend_keywords() -> list[str]:
-    """DynamoDBからトレンドキーワードリストを取得"""
-    response = TABLE_TREND_KW.scan()
-    return [item["keyword"] for item in response.get("Items", [])]
+    """DynamoDBからトレンドキーワードリストを取得（TTL付きキャッシュ）"""
+    return _cached(
+        "trend_keywords",
+        lambda: [item["keyword"] for item in scan_all(TABLE_TREND_KW, ("keyword",))],
+    )
+
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_processed_post_ids(post_ids: list[str]) -> set[str]:
+    """複数ポストIDの処理済み判定をBatchGetItemでまとめて行い、処理済みIDの集合を返す"""
+    table_name = TABLE_PROCESSED.name
+    unique_ids = list(dict.fromkeys(post_ids))
+    processed = set()
+
+    for chunk in _chunks(unique_ids, BATCH_GET_LIMIT):
+        request = {
+            table_name: {
+                "Keys": [{"post_id": post_id} for post_id in chunk],
+                "ProjectionExpression": "post_id",
+            }
+        }
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get("Responses", {}).get(table_name, []):
+                processed.add(item["post_id"])
+            request = response.get("UnprocessedKeys") or {}
+            if not request:
+                break
+            if attempt == BATCH_MAX_RETRIES:
+                raise RuntimeError(f"BatchGetItem left unprocessed keys: {request}")
+            record_retry("dynamodb.BatchGetItem")
+            time.sleep(0.05 * (2 ** attempt))
+
+    return processed
+
+
+def filter_new_post_ids(post_ids: list[str]) -> set[str]:
+    """未処理のポストIDだけを集合で返す"""
+    return set(post_ids) - get_processed_post_ids(post_ids)
+
+
+def batch_put_items(table, items: list[dict]) -> None:
+    """BatchWriteItemで25件ずつ書き込み（未処理アイテムはバックオフ付きで再送）"""
+    for chunk in _chunks(items, BATCH_WRITE_LIMIT):
+        request = {table.name: [{"PutRequest": {"Item": item}} for item in chunk]}
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            response = dynamodb.batch_write_item(RequestItems=request)
+            request = response.get("UnprocessedItems") or {}
+            if not request:
+                break
+            if attempt == BATCH_MAX_RETRIES:
+                raise RuntimeError(f"BatchWriteItem left unprocessed items: {request}")
+            record_retry("dynamodb.BatchWriteItem")
+            time.sleep(0.05 * (2 ** attempt))
+
+
+def mark_posts_processed(posts: list[tuple[str, str]], skip_reason: str | None = None) -> None:
+    """(post_id, author) のリストをBatchWriteItemでまとめて処理済みマーク
 
+    skip_reason 指定時は生成に回さなかった理由（SQSが拒否した等）も記録する。
+    """
+    now = datetime.utcnow().isoformat()
+    # 同一リクエスト内の重複キーはエラーになるため除外
+    unique = dict(posts)
+    extra = {"skip_reason": skip_reason} if skip_reason else {}
+    batch_put_items(TABLE_PROCESSED, [
+        {"post_id": post_id, "author": author, "processed_at": now, **extra}
+        for post_id, author in unique.items()
+    ])
 
-def is_post_processed(post_id: str) -> bool:
-    """ポストIDが処理済みかチェック"""
-    response = TABLE_PROCESSED.get_item(Key={"post_id": post_id})
-    return "Item" in response
 
+def send_messages_batch(queue_url: str, messages: list[tuple[str, str]]) -> tuple[set[str], set[str]]:
+    """(キー, MessageBody) のリストをSendMessageBatchで10件ずつ送信する
 
-def mark_post_processed(post_id: str, author: str) -> None:
-    """ポストIDを処理済みとしてマーク"""
-    from datetime import datetime
-    TABLE_PROCESSED.put_item(Item={
-        "post_id": post_id,
-        "author": author,
-        "processed_at": datetime.utcnow().isoformat(),
+    (送信確認できたキー, 送信者側エラーで拒否されたキー) を返す。
+    失敗したエントリはリトライし、送信者側エラー（SenderFault）は再送しても通らないため再送しない。
+    """
+    confirmed = set()
+    rejected = set()
+
+    for chunk in _chunks(messages, SQS_BATCH_LIMIT):
+        # エントリIDは英数字等のみ許可されるため、インデックスで対応付ける
+        pending = {str(i): (key, body) for i, (key, body) in enumerate(chunk)}
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            response = sqs.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {"Id": entry_id, "MessageBody": body}
+                    for entry_id, (_, body) in pending.items()
+                ],
+            )
+            for entry in response.get("Successful", []):
+                confirmed.add(pending.pop(entry["Id"])[0])
+
+            retryable = {}
+            for entry in response.get("Failed", []):
+                key, body = pending.pop(entry["Id"])
+                if entry.get("SenderFault"):
+                    print(f"SQS rejected message {key}: {entry.get('Code')} {entry.get('Message')}")
+                    rejected.add(key)
+                else:
+                    retryable[entry["Id"]] = (key, body)
+            pending = retryable
+            if not pending:
+                break
+            if attempt == BATCH_MAX_RETRIES:
+                print(f"SQS send failed after retries: {[key for key, _ in pending.values()]}")
+                break
+            record_retry("sqs.SendMessageBatch")
+            time.sleep(0.05 * (2 ** attempt))
+
+    return confirmed, rejected
+
+
+def next_engagement_refresh(posted_at: str, now: datetime | None = None) -> str | None:
+    """投稿の経過時間に応じた次回エンゲージメント更新時刻（凍結対象ならNone）"""
+    now = now or datetime.utcnow()
+    posted = datetime.fromisoformat(posted_at)
+    age_hours = (now - posted).total_seconds() / 3600
+    for max_age, interval in ENGAGEMENT_REFRESH_TIERS:
+        if age_hours < max_age:
+            due = now + timedelta(hours=interval)
+            # 段階の境界を越えて間隔を引き延ばさない
+            return min(due, posted + timedelta(hours=max_age)).isoformat()
+    return None
+
+
+_generation_cache: dict[str, tuple[float, str]] = {}
+
+
+def get_cached_generation(cache_key: str) -> dict | None:
+    """生成結果キャッシュを参照（ウォームコンテナのメモリ → DynamoDB）"""
+    now = time.time()
+    entry = _generation_cache.get(cache_key)
+    if entry and entry[0] > now:
+        return json.loads(entry[1])
+
+    response = TABLE_GEN_CACHE.get_item(Key={"cache_key": cache_key})
+    item = response.get("Item")
+    # TTL削除は遅延するため期限も確認する
+    if not item or int(item["expires_at"]) <= now:
+        return None
+    _remember_generation(cache_key, int(item["expires_at"]), item["result"])
+    return json.loads(item["result"])
+
+
+def put_cached_generation(cache_key: str, result: dict) -> None:
+    """生成結果をキャッシュ（JSON文字列で保存し、参照側で都度デコードする）"""
+    expires_at = int(time.time()) + GENERATION_CACHE_TTL_HOURS * 3600
+    payload = json.dumps(result, ensure_ascii=False)
+    TABLE_GEN_CACHE.put_item(Item={
+        "cache_key": cache_key,
+        "result": payload,
+        "expires_at": expires_at,
     })
+    _remember_generation(cache_key, expires_at, payload)
+
+
+def _remember_generation(cache_key: str, expires_at: float, payload: str) -> None:
+    if cache_key not in _generation_cache and len(_generation_cache) >= GENERATION_CACHE_MEMORY_SIZE:
+        _generation_cache.pop(next(iter(_generation_cache)))
+    _generation_cache[cache_key] = (expires_at, payload)
 
 
 def save_post_history(post_data: dict) -> None:
-    """投稿履歴をDynamoDBに保存"""
-    TABLE_HISTORY.put_item(Item=post_data)
+    """投稿履歴をDynamoDBに保存（日付バケット posted_date と初回更新予定を付与）"""
+    item = {"posted_date": post_data["posted_at"][:10], **post_data}
+    if "next_refresh_at" not in item:
+        item["next_refresh_at"] = next_engagement_refresh(item["posted_at"])
+    TABLE_HISTORY.put_item(Item=item)
+
+
+def get_recent_post_history(days: int, due_by: str | None = None) -> list[dict]:
+    """直近days日分の投稿履歴を日付バケットGSIのクエリで取得
+
+    due_by 指定時は next_refresh_at がその時刻以前（未設定を含む）で凍結されていない投稿だけを返す。
+    """
+    now = datetime.utcnow()
+    cutoff = (now - timedelta(days=days)).isoformat()
+    params = {
+        "IndexName": HISTORY_DATE_INDEX,
+        "KeyConditionExpression": "posted_date = :d AND posted_at >= :cutoff",
+    }
+    values = {":cutoff": cutoff}
+    if due_by:
+        params["FilterExpression"] = (
+            "(attribute_not_exists(next_refresh_at) OR next_refresh_at <= :due)"
+            " AND attribute_not_exists(refresh_frozen)"
+        )
+        values[":due"] = due_by
+
+    posts = []
+    # cutoff当日から今日までのバケットだけを読む
+    for offset in range(days + 1):
+        bucket = (now - timedelta(days=offset)).strftime("%Y-%m-%d")
+        posts.extend(query_all(
+            TABLE_HISTORY,
+            ExpressionAttributeValues={**values, ":d": bucket},
+            **params,
+        ))
+    return posts
 
 
 # Style Guidelines（デフォルト: 織田設定）
@@ -1,90 +1,175 @@
 """
 qr-engagement: エンゲージメント収集 Lambda
-トリガー: EventBridge (日次)
+トリガー: EventBridge (1時間ごと)
 役割: 過去に投稿した引用リポストのIMP・いいね・RT等を取得してDynamoDBを更新
+投稿直後は密に、経過日数に応じて間隔を空け、14日を過ぎたら凍結する（next_refresh_at）
+更新予定時刻を迎えた投稿だけをクエリで取得し、変化した項目だけを UpdateItem で書き込む
 ダッシュボード用データの更新に使用
 """
 
 import json
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
 import tweepy
-from config import get_x_credentials, TABLE_HISTORY
+from config import (
+    call_with_reauth,
+    get_x_client,
+    get_recent_post_history,
+    next_engagement_refresh,
+    TABLE_HISTORY,
+    ENGAGEMENT_CONCURRENCY,
+    ENGAGEMENT_WINDOW_DAYS,
+    acquire_x_budget,
+    x_rate_budget,
+    instrumented_handler,
+    trace_stage,
+)
 
+# get_tweets の1リクエストあたりのID上限
+TWEET_LOOKUP_LIMIT = 100
 
-def get_x_client() -> tweepy.Client:
-    creds = get_x_credentials()
-    return tweepy.Client(
-        consumer_key=creds["api_key"],
-        consumer_secret=creds["api_secret"],
-        access_token=creds["access_token"],
-        access_token_secret=creds["access_secret"],
+
+def to_engagement(metrics: dict) -> dict:
+    """public_metrics をエンゲージメント項目に変換（DynamoDB用にDecimal）"""
+    engagement = {
+        "impressions": metrics.get("impression_count", 0),
+        "likes": metrics.get("like_count", 0),
+        "retweets": metrics.get("retweet_count", 0),
+        "bookmarks": metrics.get("bookmark_count", 0),
+        "replies": metrics.get("reply_count", 0),
+    }
+
+    # エンゲージメント率を計算
+    imp = engagement["impressions"]
+    total_eng = (
+        engagement["likes"]
+        + engagement["retweets"]
+        + engagement["bookmarks"]
+        + engagement["replies"]
     )
+    engagement["rate"] = Decimal(str(round(total_eng / imp * 100, 2))) if imp > 0 else Decimal(0)
+    return engagement
 
 
-def lambda_handler(event, context):
-    """過去14日間の投稿のエンゲージメントを取得して更新"""
-    client = get_x_client()
+def fetch_metrics(tweet_ids: list[str]) -> dict[str, dict]:
+    """複数IDをまとめて取得し、tweet_id → public_metrics を返す（チャンクを並列実行）"""
+    chunks = [
+        tweet_ids[i:i + TWEET_LOOKUP_LIMIT]
+        for i in range(0, len(tweet_ids), TWEET_LOOKUP_LIMIT)
+    ]
+
+    def lookup(chunk: list[str]) -> dict[str, dict]:
+        try:
+            with trace_stage("x.get_tweets"):
+                response = call_with_reauth(
+                    get_x_client, lambda client: client.get_tweets(ids=chunk, tweet_fields=["public_metrics"]),
+                )
+        except tweepy.TweepyException as e:
+            print(f"Error fetching metrics for {len(chunk)} tweets: {e}")
+            return {}
+        return {
+            str(tweet.id): tweet.public_metrics
+            for tweet in (response.data or [])
+            if tweet.public_metrics
+        }
+
+    metrics = {}
+    if not chunks:
+        return metrics
+    with ThreadPoolExecutor(max_workers=max(1, min(ENGAGEMENT_CONCURRENCY, len(chunks)))) as executor:
+        for result in executor.map(lookup, chunks):
+            metrics.update(result)
+    return metrics
+
+
+def save_refresh(post: dict, engagement: dict | None, next_refresh_at: str | None, now: str) -> None:
+    """エンゲージメント（変化時のみ）と次回更新予定を部分更新する
 
-    # 投稿履歴テーブルから直近14日分を取得
-    cutoff = (datetime.utcnow() - timedelta(days=14)).isoformat()
+    行全体を書き戻さないため、他の処理が同じ行に加えた変更を上書きしない。
+    """
+    assignments = []
+    values = {}
+    if engagement is not None:
+        assignments += ["engagement = :e", "last_updated = :u"]
+        values.update({":e": engagement, ":u": now})
+    if next_refresh_at:
+        assignments.append("next_refresh_at = :n")
+        values[":n"] = next_refresh_at
+        expression = "SET " + ", ".join(assignments)
+    else:
+        # 最後の段階を過ぎたら凍結
+        assignments.append("refresh_frozen = :f")
+        values[":f"] = True
+        expression = "SET " + ", ".join(assignments) + " REMOVE next_refresh_at"
 
-    response = TABLE_HISTORY.scan(
-        FilterExpression="posted_at >= :cutoff",
-        ExpressionAttributeValues={":cutoff": cutoff},
+    TABLE_HISTORY.update_item(
+        Key={"post_id": post["post_id"], "posted_at": post["posted_at"]},
+        UpdateExpression=expression,
+        ExpressionAttributeValues=values,
     )
 
-    posts = response.get("Items", [])
-    updated_count = 0
 
-    for post in posts:
-        tweet_id = post["post_id"]
+def limit_to_budget(due_posts: list[dict]) -> list[dict]:
+    """X APIの残り回数（予約枠を除く）で取得できる分だけに絞る（更新予定が古い順）
 
-        try:
-            tweet = client.get_tweet(
-                id=tweet_id,
-                tweet_fields=["public_metrics"],
-            )
-
-            if tweet.data and tweet.data.public_metrics:
-                metrics = tweet.data.public_metrics
-                engagement = {
-                    "impressions": metrics.get("impression_count", 0),
-                    "likes": metrics.get("like_count", 0),
-                    "retweets": metrics.get("retweet_count", 0),
-                    "bookmarks": metrics.get("bookmark_count", 0),
-                    "replies": metrics.get("reply_count", 0),
-                }
-
-                # エンゲージメント率を計算
-                imp = engagement["impressions"]
-                total_eng = (
-                    engagement["likes"]
-                    + engagement["retweets"]
-                    + engagement["bookmarks"]
-                    + engagement["replies"]
-                )
-                engagement["rate"] = round(total_eng / imp * 100, 2) if imp > 0 else 0
-
-                TABLE_HISTORY.update_item(
-                    Key={
-                        "post_id": tweet_id,
-                        "posted_at": post["posted_at"],
-                    },
-                    UpdateExpression="SET engagement = :e, last_updated = :u",
-                    ExpressionAttributeValues={
-                        ":e": engagement,
-                        ":u": datetime.utcnow().isoformat(),
-                    },
-                )
-                updated_count += 1
+    エンゲージメント更新は優先度が低いため、承認投稿・監視用の枠を残す。
+    絞られた投稿は next_refresh_at を据え置き、次回の実行で対象になる。
+    """
+    requests_needed = -(-len(due_posts) // TWEET_LOOKUP_LIMIT)
+    budget = x_rate_budget("tweets_lookup", "low")
+    if budget is not None and budget < requests_needed:
+        due_posts = sorted(due_posts, key=lambda post: post.get("next_refresh_at", ""))
+        due_posts = due_posts[:budget * TWEET_LOOKUP_LIMIT]
+        requests_needed = budget
+    if requests_needed and not acquire_x_budget("tweets_lookup", requests_needed, "low"):
+        return []
+    return due_posts
 
-        except tweepy.TweepyException as e:
-            print(f"Error fetching metrics for {tweet_id}: {e}")
+
+@instrumented_handler("qr-engagement")
+def lambda_handler(event, context):
+    """更新予定時刻を迎えた投稿のエンゲージメントを取得して更新"""
+    now_dt = datetime.utcnow()
+    now = now_dt.isoformat()
+    # 直近の日付バケットから、更新予定を迎えた未凍結の投稿だけをクエリで取得
+    due_posts = get_recent_post_history(days=ENGAGEMENT_WINDOW_DAYS, due_by=now)
+    due_count = len(due_posts)
+    due_posts = limit_to_budget(due_posts)
+    if len(due_posts) < due_count:
+        print(f"X API budget low: refreshing {len(due_posts)}/{due_count} due posts")
+    metrics_by_id = fetch_metrics([post["post_id"] for post in due_posts])
+
+    refreshes = []
+    changed_count = 0
+    for post in due_posts:
+        metrics = metrics_by_id.get(post["post_id"])
+        if not metrics:
             continue
 
+        engagement = to_engagement(metrics)
+        # 前回更新から変化がなければ次回更新予定だけを書き込む
+        if engagement == post.get("engagement"):
+            engagement = None
+        else:
+            changed_count += 1
+
+        # 経過時間に応じて次回更新時刻を決定（段階を過ぎたら凍結）
+        next_refresh_at = next_engagement_refresh(post["posted_at"], now_dt)
+        refreshes.append((post, engagement, next_refresh_at, now))
+
+    if refreshes:
+        workers = max(1, min(ENGAGEMENT_CONCURRENCY, len(refreshes)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda args: save_refresh(*args), refreshes))
+
     return {
         "statusCode": 200,
         "body": json.dumps({
-            "message": f"Engagement updated for {updated_count}/{len(posts)} posts",
+            "message": f"Engagement updated for {changed_count}/{len(due_posts)} due posts",
+            "due": due_count,
+            "deferred": due_count - len(due_posts),
+            "fetched": len(metrics_by_id),
+            "unchanged": len(metrics_by_id) - changed_count,
         }),
     }
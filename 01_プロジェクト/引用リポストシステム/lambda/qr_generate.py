@@ -4,19 +4,30 @@ qr-generate: 引用リポスト3案生成 + 校正 + チェック Lambda
 役割: AI生成 → 校正 → アルゴリズムチェック → 通知Lambdaを呼び出し
 """
 
+import hashlib
 import json
 import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import anthropic
-import boto3
+from decimal import Decimal
 from config import (
-    get_claude_api_key,
+    call_with_reauth,
+    get_anthropic_client,
     get_trend_keywords,
+    lambda_client,
+    TABLE_PROCESSED,
     DEFAULT_STYLE,
+    GENERATE_CONCURRENCY,
+    GENERATION_MODE,
+    get_cached_generation,
+    put_cached_generation,
+    instrumented_handler,
+    record_retry,
+    record_token_usage,
+    traced,
 )
 
-lambda_client = boto3.client("lambda", region_name="ap-northeast-1")
-
 # ──────────────────────────────────────
 # System Prompt（04_引用リポスト生成プロンプト.md の内容）
 # ──────────────────────────────────────
@@ -93,11 +104,58 @@ NORMAL_MODE_ADDITION = """
 通常モード: 140〜280文字で生成してください。
 """
 
+# 1案だけの修正はSystem Promptのキャッシュを保つためユーザー入力側で指示する
+SINGLE_REVISION_INSTRUCTION = """## 出力
+上記「修正対象の案」1つだけを修正指示に沿って書き直し、draftsに1要素のみを含む同じJSON形式で出力してください。"""
+
+# 1案のみの修正時の出力トークン上限
+REVISION_MAX_TOKENS = {"normal": 1024, "long": 2560}
+
+
+def _output_format_example() -> dict:
+    """System Prompt の出力フォーマット（JSON例）を読み取る"""
+    section = SYSTEM_PROMPT[SYSTEM_PROMPT.index("## 出力フォーマット"):]
+    return json.loads(section[section.index("{"):])
+
+
+# 1案の項目と自己採点の項目（System Prompt の出力フォーマットから導出し、スキーマと食い違わないようにする）
+DRAFT_EXAMPLE = _output_format_example()["drafts"][0]
+DRAFT_TEXT_KEYS = tuple(key for key, value in DRAFT_EXAMPLE.items() if isinstance(value, str))
+SCORE_ASSESSMENT_KEYS = tuple(DRAFT_EXAMPLE["score_self_assessment"])
+
+# tool モードで drafts 構造をスキーマとして指定する
+DRAFTS_TOOL = {
+    "name": "submit_drafts",
+    "description": "生成した引用リポスト3案を提出する",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "drafts": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        **{key: {"type": "string"} for key in DRAFT_TEXT_KEYS},
+                        "score_self_assessment": {
+                            "type": "object",
+                            "properties": {key: {"type": "number"} for key in SCORE_ASSESSMENT_KEYS},
+                            "required": list(SCORE_ASSESSMENT_KEYS),
+                        },
+                    },
+                    "required": ["type", "text", "score_self_assessment"],
+                },
+            },
+        },
+        "required": ["drafts"],
+    },
+}
+
 
 # ──────────────────────────────────────
 # AI生成
 # ──────────────────────────────────────
 
+@traced("claude.generate_drafts")
 def generate_drafts(
     original_text: str,
     author_profile: dict,
@@ -105,17 +163,24 @@ def generate_drafts(
     trend_keywords: list[str],
     mode: str = "normal",
     revision_instruction: str | None = None,
+    generation_mode: str = GENERATION_MODE,
+    prior_draft: dict | None = None,
 ) -> dict:
-    """Claude APIで3案を生成"""
-    client = anthropic.Anthropic(api_key=get_claude_api_key())
+    """Claude APIで3案を生成（prior_draft 指定時はその1案のみを修正して生成）
 
+    generation_mode: "stream"（逐次パース、案ごとに検証済みの結果も返す） /
+    "tool"（ツールスキーマで構造化出力） / "text"（一括応答を正規表現で抽出）
+    """
     mode_prompt = LONG_MODE_ADDITION if mode == "long" else NORMAL_MODE_ADDITION
-    system = SYSTEM_PROMPT + mode_prompt
-
-    user_content = f"""## 元ポスト
-{original_text}
-
-## 投稿者プロファイル
+    # 静的なSystem Promptはモードごとにバイト一致するためキャッシュ対象にする
+    system = [{
+        "type": "text",
+        "text": SYSTEM_PROMPT + mode_prompt,
+        "cache_control": {"type": "ephemeral"},
+    }]
+
+    # 投稿者プロファイル + Style Guidelines は同一投稿者で共通のため、可変部分より前に置いてキャッシュする
+    profile_content = f"""## 投稿者プロファイル
 テーマ: {author_profile.get('primary_theme', '不明')}
 思考パターン: {author_profile.get('thinking_pattern', '不明')}
 語彙特徴: {author_profile.get('vocabulary_features', '不明')}
@@ -124,7 +189,10 @@ def generate_drafts(
 
 ## Style Guidelines
 一人称: {', '.join(DEFAULT_STYLE['first_person'])}
-二人称: {', '.join(DEFAULT_STYLE['second_person'])}
+二人称: {', '.join(DEFAULT_STYLE['second_person'])}"""
+
+    user_content = f"""## 元ポスト
+{original_text}
 
 ## トレンドキーワード（自然に1つ以上織り込むこと）
 {', '.join(trend_keywords[:20])}
@@ -132,66 +200,312 @@ def generate_drafts(
 ## モード
 {mode}"""
 
+    if prior_draft:
+        user_content += f"\n\n## 修正対象の案\n型: {prior_draft.get('type', '')}\n{prior_draft.get('text', '')}"
+
     if revision_instruction:
         user_content += f"\n\n## 修正指示\n{revision_instruction}"
 
-    response = client.messages.create(
-        model="claude-sonnet-4-5-20250514",
-        max_tokens=4096,
-        system=system,
-        messages=[{"role": "user", "content": user_content}],
+    if prior_draft:
+        user_content += f"\n\n{SINGLE_REVISION_INSTRUCTION}"
+
+    request = {
+        "model": "claude-sonnet-4-5-20250514",
+        "max_tokens": REVISION_MAX_TOKENS.get(mode, 1024) if prior_draft else 4096,
+        "system": system,
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": profile_content, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": user_content},
+            ],
+        }],
+    }
+    usage_context = {"mode": mode, "author": author_profile.get("account_id", "")}
+    # APIキーのローテーション直後の401はクライアントを作り直して1回だけ再試行する
+    return call_with_reauth(
+        get_anthropic_client,
+        lambda client: request_drafts(client, request, generation_mode, trend_keywords, usage_context),
     )
 
+
+def request_drafts(
+    client, request: dict, generation_mode: str, trend_keywords: list[str], usage_context: dict,
+) -> dict:
+    """generation_mode に応じてClaude APIを呼び出し、drafts を取り出す"""
+    if generation_mode == "stream":
+        return generate_drafts_streaming(client, request, trend_keywords, usage_context)
+
+    if generation_mode == "tool":
+        response = client.messages.create(
+            **request,
+            tools=[DRAFTS_TOOL],
+            tool_choice={"type": "tool", "name": DRAFTS_TOOL["name"]},
+        )
+        log_usage(response, tool=True, **usage_context)
+        for block in response.content:
+            if block.type == "tool_use" and block.name == DRAFTS_TOOL["name"]:
+                return block.input
+        raise ValueError("Claude response did not include submit_drafts tool call")
+
+    response = client.messages.create(**request)
+    log_usage(response, **usage_context)
+
     # JSONパース
     response_text = response.content[0].text
-    # JSON部分を抽出（コードブロック内の場合も対応）
+    return parse_drafts_json(response_text)
+
+
+def parse_drafts_json(response_text: str) -> dict:
+    """応答全体からJSON部分を抽出（コードブロック内の場合も対応）"""
     json_match = re.search(r'\{[\s\S]*\}', response_text)
     if json_match:
         return json.loads(json_match.group())
     raise ValueError(f"Failed to parse JSON from Claude response: {response_text[:200]}")
 
 
+class DraftStreamParser:
+    """ストリーミング応答から drafts 配列の要素を完成した順に取り出す"""
+
+    DRAFTS_START = re.compile(r'"drafts"\s*:\s*\[')
+    # この文字数を受信しても JSON / drafts 配列が始まらなければ不正とみなす
+    MAX_PREAMBLE = 500
+
+    def __init__(self, on_draft):
+        self.on_draft = on_draft
+        self.buffer = ""
+        self.pos = None        # drafts 配列内の走査位置
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.object_start = None
+        self.closed = False
+        self.drafts = []
+
+    def feed(self, chunk: str) -> None:
+        self.buffer += chunk
+        if self.closed:
+            return
+
+        if self.pos is None:
+            match = self.DRAFTS_START.search(self.buffer)
+            if not match:
+                first_brace = self.buffer.find("{")
+                preamble = len(self.buffer) if first_brace < 0 else first_brace
+                if preamble > self.MAX_PREAMBLE or len(self.buffer) > self.MAX_PREAMBLE * 4:
+                    raise ValueError(f"Malformed stream (no drafts array): {self.buffer[:200]}")
+                return
+            self.pos = match.end()
+
+        buffer = self.buffer
+        for i in range(self.pos, len(buffer)):
+            ch = buffer[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                # 配列直下の文字列要素は案ではないため、読み飛ばさずに不正とする
+                if self.depth == 0:
+                    raise ValueError("Malformed stream (string element in drafts array)")
+                self.in_string = True
+            elif ch == "{":
+                if self.depth == 0:
+                    self.object_start = i
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self._emit(buffer[self.object_start:i + 1])
+            elif ch == "]" and self.depth == 0:
+                self.closed = True
+                break
+            elif self.depth == 0 and not (ch.isspace() or ch == ","):
+                raise ValueError(f"Malformed stream (unexpected {ch!r} in drafts array)")
+        self.pos = len(buffer)
+
+    def _emit(self, raw: str) -> None:
+        try:
+            draft = json.loads(raw)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Malformed draft in stream: {e}") from e
+        if not isinstance(draft, dict) or "text" not in draft or "type" not in draft:
+            raise ValueError(f"Draft missing required fields: {raw[:200]}")
+        self.drafts.append(draft)
+        self.on_draft(draft)
+
+
+def generate_drafts_streaming(client, request: dict, trend_keywords: list[str], usage_context: dict) -> dict:
+    """ストリーミングで生成し、完成した案から順に validate_draft にかける
+
+    不正な出力は最後まで待たずに中断して ValueError を送出する（呼び出し側でリトライ）。
+    """
+    validated = []
+    parser = DraftStreamParser(lambda draft: validated.append(validate_draft(draft, trend_keywords)))
+
+    with client.messages.stream(**request) as stream:
+        for text in stream.text_stream:
+            parser.feed(text)
+        final = stream.get_final_message()
+    log_usage(final, streamed=True, **usage_context)
+
+    if not parser.closed:
+        # 配列が閉じないまま終了した場合は従来の一括パースに委ねる
+        return parse_drafts_json(parser.buffer)
+    return {"drafts": parser.drafts, "validated_drafts": validated}
+
+
+def log_usage(response, **context) -> dict:
+    """response.usage からトークン使用量とプロンプトキャッシュのヒット状況を記録"""
+    usage = response.usage
+    record = {
+        "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+    }
+    record["cache_hit"] = record["cache_read_input_tokens"] > 0
+    record_token_usage(record)
+    print(json.dumps({"event": "claude_usage", **context, **record}, ensure_ascii=False))
+    return record
+
+
 # ──────────────────────────────────────
 # 校正エンジン
 # ──────────────────────────────────────
 
+# Markdown自動修正ルール（見出し・リストは行頭のみ）
+MARKDOWN_RULES = [
+    (re.compile(r"\*\*(.+?)\*\*", re.MULTILINE), r"\1"),  # **太字**
+    (re.compile(r"^#+\s", re.MULTILINE), ""),               # 見出し
+    (re.compile(r"^-\s", re.MULTILINE), ""),                # リスト
+]
+
+EMOJI_PATTERN = re.compile(
+    "[\U0001F600-\U0001F64F\U0001F300-\U0001F5FF"
+    "\U0001F680-\U0001F6FF\U0001F1E0-\U0001F1FF"
+    "\U00002702-\U000027B0\U0001F900-\U0001F9FF"
+    "\U0001FA00-\U0001FA6F\U0001FA70-\U0001FAFF"
+    "\U00002600-\U000026FF]+",
+    flags=re.UNICODE,
+)
+
+STYLE_ENGINE_CACHE_SIZE = 32
+
+
+def _trie_pattern(node: dict) -> str:
+    """トライを正規表現に変換（共通接頭辞を共有し、終端は貪欲な省略可能グループで最長一致を優先）"""
+    branches = [re.escape(ch) + _trie_pattern(child) for ch, child in sorted(node.items()) if ch]
+    if not branches:
+        return ""
+    body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    return f"(?:{body})?" if "" in node else body
+
+
+class KeywordMatcher:
+    """複数キーワードを1パスで検索するマッチャー（トライ構造の正規表現を各位置で先読み）"""
+
+    def __init__(self, keywords: list[str]):
+        words = list(dict.fromkeys(w for w in keywords if w))
+        self.keywords = words
+        trie: dict = {}
+        for word in words:
+            node = trie
+            for ch in word:
+                node = node.setdefault(ch, {})
+            node[""] = {}
+        self.regex = re.compile(f"(?=({_trie_pattern(trie)}))") if words else None
+        # ある位置で長い語が一致したとき、同じ位置にはその前方一致の短い語も存在する
+        word_set = set(words)
+        self.prefixes = {
+            w: [w[:i] for i in range(len(w) - 1, 0, -1) if w[:i] in word_set]
+            for w in words
+        }
+
+    def find_positions(self, text: str) -> dict[str, list[int]]:
+        """一致したキーワード → 出現位置のリスト（初出順）"""
+        positions: dict[str, list[int]] = {}
+        if self.regex is None:
+            return positions
+        for match in self.regex.finditer(text):
+            start = match.start()
+            word = match.group(1)
+            positions.setdefault(word, []).append(start)
+            for prefix in self.prefixes[word]:
+                positions.setdefault(prefix, []).append(start)
+        return positions
+
+
+class StyleEngine:
+    """スタイル辞書から構築する校正用のコンパイル済みマッチャー"""
+
+    def __init__(self, style: dict):
+        self.forbidden_words = list(style["forbidden_words"])
+        self.forbidden = KeywordMatcher(self.forbidden_words)
+
+        self.kansai_patterns = [
+            (pattern, re.compile(pattern, re.MULTILINE)) for pattern in style["kansai_patterns"]
+        ]
+        self.kansai_any = (
+            re.compile("|".join(f"(?:{p})" for p, _ in self.kansai_patterns), re.MULTILINE)
+            if self.kansai_patterns else None
+        )
+
+    def find_forbidden(self, text: str) -> list[str]:
+        """含まれる禁止ワードを style の定義順で返す"""
+        found = self.forbidden.find_positions(text)
+        # 空文字は常に含まれる扱い（従来の部分文字列判定と同じ）
+        return [w for w in self.forbidden_words if not w or w in found]
+
+    def find_kansai(self, text: str) -> list[str]:
+        """一致した関西弁パターンを定義順で返す（大半は結合パターン1回で終わる）"""
+        if self.kansai_any is None or not self.kansai_any.search(text):
+            return []
+        return [pattern for pattern, regex in self.kansai_patterns if regex.search(text)]
+
+
+_style_engines: dict[int, tuple[dict, StyleEngine]] = {}
+
+
+def get_style_engine(style: dict) -> StyleEngine:
+    """スタイル辞書ごとにエンジンを1度だけ構築してキャッシュ"""
+    entry = _style_engines.get(id(style))
+    if entry and entry[0] is style:
+        return entry[1]
+    engine = StyleEngine(style)
+    if len(_style_engines) >= STYLE_ENGINE_CACHE_SIZE:
+        _style_engines.pop(next(iter(_style_engines)))
+    # id の再利用で別の辞書と取り違えないよう、辞書自体も保持する
+    _style_engines[id(style)] = (style, engine)
+    return engine
+
+
 def proofread(text: str, style: dict = DEFAULT_STYLE) -> dict:
     """校正チェック: 禁止ワード、語尾、文字数、Markdown、絵文字"""
+    engine = get_style_engine(style)
     issues = []
     corrected = text
 
     # 1. 禁止ワードチェック
-    for word in style["forbidden_words"]:
-        if word in corrected:
-            issues.append({"type": "forbidden_word", "word": word, "severity": "warning"})
+    for word in engine.find_forbidden(corrected):
+        issues.append({"type": "forbidden_word", "word": word, "severity": "warning"})
 
     # 2. 関西弁チェック
-    for pattern in style["kansai_patterns"]:
-        if re.search(pattern, corrected, re.MULTILINE):
-            issues.append({"type": "kansai_dialect", "pattern": pattern, "severity": "error"})
+    for pattern in engine.find_kansai(corrected):
+        issues.append({"type": "kansai_dialect", "pattern": pattern, "severity": "error"})
 
     # 3. Markdown削除
-    markdown_patterns = [
-        (r"\*\*(.+?)\*\*", r"\1"),  # **太字**
-        (r"^#+\s", ""),             # 見出し
-        (r"^-\s", ""),              # リスト
-    ]
-    for pattern, replacement in markdown_patterns:
-        if re.search(pattern, corrected, re.MULTILINE):
-            corrected = re.sub(pattern, replacement, corrected, flags=re.MULTILINE)
+    for regex, replacement in MARKDOWN_RULES:
+        corrected, count = regex.subn(replacement, corrected)
+        if count:
             issues.append({"type": "markdown_removed", "severity": "auto_fixed"})
 
     # 4. 絵文字削除
-    emoji_pattern = re.compile(
-        "[\U0001F600-\U0001F64F\U0001F300-\U0001F5FF"
-        "\U0001F680-\U0001F6FF\U0001F1E0-\U0001F1FF"
-        "\U00002702-\U000027B0\U0001F900-\U0001F9FF"
-        "\U0001FA00-\U0001FA6F\U0001FA70-\U0001FAFF"
-        "\U00002600-\U000026FF]+",
-        flags=re.UNICODE,
-    )
-    if emoji_pattern.search(corrected):
-        corrected = emoji_pattern.sub("", corrected)
+    corrected, count = EMOJI_PATTERN.subn("", corrected)
+    if count:
         issues.append({"type": "emoji_removed", "severity": "auto_fixed"})
 
     # 5. 文字数チェック
@@ -223,9 +537,30 @@ def check_specificity(text: str) -> int:
     return min(score, 10)
 
 
+_trend_matcher: tuple[list[str], tuple[str, ...], KeywordMatcher] | None = None
+
+
+def get_trend_matcher(trend_keywords: list[str]) -> KeywordMatcher:
+    """キーワードセットが変わった時だけマッチャーを再構築（ウォームコンテナ間で共有）"""
+    global _trend_matcher
+    if _trend_matcher and _trend_matcher[0] is trend_keywords:
+        return _trend_matcher[2]
+    key = tuple(trend_keywords)
+    if _trend_matcher and _trend_matcher[1] == key:
+        matcher = _trend_matcher[2]
+    else:
+        matcher = KeywordMatcher(trend_keywords)
+    _trend_matcher = (trend_keywords, key, matcher)
+    return matcher
+
+
 def check_trend_keywords(text: str, trend_keywords: list[str]) -> dict:
-    """トレンドKWが含まれているかチェック"""
-    used = [kw for kw in trend_keywords if kw in text]
+    """トレンドKWが含まれているかチェック（used_keywords はキーワードリストの順）
+
+    出現位置が必要な場合は get_trend_matcher(...).find_positions を使う。
+    """
+    found = get_trend_matcher(trend_keywords).find_positions(text)
+    used = [kw for kw in trend_keywords if kw in found]
     return {
         "has_trend_kw": len(used) > 0,
         "used_keywords": used,
@@ -233,6 +568,7 @@ def check_trend_keywords(text: str, trend_keywords: list[str]) -> dict:
     }
 
 
+@traced("validate_draft")
 def validate_draft(draft: dict, trend_keywords: list[str]) -> dict:
     """1案の品質を総合検証"""
     text = draft["text"]
@@ -250,7 +586,7 @@ def validate_draft(draft: dict, trend_keywords: list[str]) -> dict:
     ai_score = draft.get("score_self_assessment", {})
     # 具体性だけ自動計算で上書き
     ai_score["specificity"] = specificity_score
-    total = sum(v for k, v in ai_score.items() if k != "total")
+    total = sum(ai_score.get(k, 0) for k in SCORE_ASSESSMENT_KEYS if k != "total")
     ai_score["total"] = total
 
     return {
@@ -269,74 +605,247 @@ def validate_draft(draft: dict, trend_keywords: list[str]) -> dict:
     }
 
 
-# ──────────────────────────────────────
-# メインハンドラー
-# ──────────────────────────────────────
+def compact_draft(draft: dict) -> dict:
+    """通知・投稿に必要な項目だけを残した保存用の原稿（数値はDynamoDB用にDecimal）"""
+    trend = draft.get("trend_keywords", {})
+    return {
+        "type": draft.get("type", ""),
+        "text": draft["text"],
+        "total_score": Decimal(str(draft.get("total_score", 0))),
+        "char_count": draft.get("char_count", len(draft["text"])),
+        "used_keywords": trend.get("used_keywords", []),
+    }
 
-def lambda_handler(event, context):
-    """SQSトリガー: 新規ポストに対して3案生成+校正+チェック"""
-    for record in event.get("Records", []):
-        message = json.loads(record["body"])
 
-        post_id = message["post_id"]
-        original_text = message["text"]
-        author = message["author"]
-        author_profile = message["author_profile"]
-        mode = message.get("mode", "normal")
-        revision_instruction = message.get("revision_instruction")
+def generation_cache_key(
+    original_text: str,
+    author_profile: dict,
+    mode: str,
+    trend_keywords: list[str],
+    revision_instruction: str | None,
+    prior_draft: dict | None,
+) -> str:
+    """生成入力を正規化したハッシュ（同一入力なら同じキー）"""
+    normalized = " ".join(unicodedata.normalize("NFKC", original_text).split())
+    material = json.dumps({
+        "text": normalized,
+        "profile": author_profile,
+        "mode": mode,
+        "trend_keywords": sorted(set(trend_keywords)),
+        "revision_instruction": (revision_instruction or "").strip(),
+        "prior_draft": prior_draft or {},
+    }, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
 
-        print(f"Processing post {post_id} from {author} (mode: {mode})")
 
-        # トレンドKW取得
-        trend_keywords = get_trend_keywords()
+# ──────────────────────────────────────
+# メインハンドラー
+# ──────────────────────────────────────
 
-        # AI生成（最大2回リトライ）
-        max_retries = 2
+def generate_with_retries(post_id: str, max_retries: int = 2, **kwargs) -> dict:
+    """generate_drafts を最大 max_retries 回リトライし、試行回数・パース失敗数を記録"""
+    parse_failures = 0
+    attempt = 0
+    try:
         for attempt in range(max_retries + 1):
             try:
-                result = generate_drafts(
-                    original_text=original_text,
-                    author_profile=author_profile,
+                return generate_drafts(
                     style_guidelines="",  # System Promptに組み込み済み
-                    trend_keywords=trend_keywords,
-                    mode=mode,
-                    revision_instruction=revision_instruction,
+                    **kwargs,
                 )
-                break
             except Exception as e:
+                # JSONDecodeError も ValueError のサブクラス
+                if isinstance(e, ValueError):
+                    parse_failures += 1
                 print(f"Generation attempt {attempt + 1} failed: {e}")
                 if attempt == max_retries:
                     print(f"All retries failed for post {post_id}")
-                    return {"statusCode": 500, "body": str(e)}
+                    raise
+    finally:
+        # 生成方式ごとのパース失敗率・リトライ率を集計するための記録
+        record_retry("claude.generate_drafts", attempt)
+        print(json.dumps({
+            "event": "generation_attempts",
+            "post_id": post_id,
+            "generation_mode": GENERATION_MODE,
+            "attempts": attempt + 1,
+            "retries": attempt,
+            "parse_failures": parse_failures,
+        }))
+
+
+def process_post(message: dict, trend_keywords: list[str]) -> str:
+    """1ポスト分の生成 → 検証 → 通知（失敗時は例外を送出）"""
+    post_id = message["post_id"]
+    original_text = message["text"]
+    author = message["author"]
+    author_profile = message["author_profile"]
+    mode = message.get("mode", "normal")
+    revision_instruction = message.get("revision_instruction")
+    # 1案だけの修正（qr-postが選択案のインデックスと修正前の本文を付与）
+    draft_index = message.get("draft_index")
+    prior_draft = message.get("prior_draft") if draft_index is not None else None
+
+    print(f"Processing post {post_id} from {author} (mode: {mode})")
+
+    cache_key = generation_cache_key(
+        original_text, author_profile, mode, trend_keywords, revision_instruction, prior_draft,
+    )
 
-        # 各案を検証
-        validated_drafts = []
-        for draft in result.get("drafts", []):
-            validated = validate_draft(draft, trend_keywords)
-            validated_drafts.append(validated)
+    # SQSの再配信: 同じ入力の原稿を保存済みなら保存し直さない（通知済みの原稿を再通知しない）
+    stored = TABLE_PROCESSED.get_item(
+        Key={"post_id": post_id},
+        ProjectionExpression="generation_key, notification_sent",
+    ).get("Item") or {}
+    if stored.get("generation_key") == cache_key:
+        if stored.get("notification_sent"):
+            print(f"Drafts for post {post_id} already notified. Skipping redelivery.")
+            return "duplicate"
+        # 通知が途中なら qr-notify が届いた分の続きから送る
+        invoke_notify(post_id)
+        return "notified"
+
+    result = get_cached_generation(cache_key)
+    if result is not None:
+        print(f"Generation cache hit for post {post_id}")
+    else:
+        result = generate_with_retries(
+            post_id=post_id,
+            original_text=original_text,
+            author_profile=author_profile,
+            trend_keywords=trend_keywords,
+            mode=mode,
+            revision_instruction=revision_instruction,
+            prior_draft=prior_draft,
+        )
+        # 検証結果は入力が同じでも再計算できるため、生成された原稿のみを保存する
+        put_cached_generation(cache_key, {"drafts": result.get("drafts", [])})
 
-        # 60点未満の案は除外
-        go_drafts = [d for d in validated_drafts if d["total_score"] >= 60]
+    # 各案を検証（ストリーミング時は生成中に検証済み）
+    validated_drafts = result.get("validated_drafts")
+    if validated_drafts is None:
+        validated_drafts = [validate_draft(draft, trend_keywords) for draft in result.get("drafts", [])]
 
-        if not go_drafts:
-            print(f"All drafts scored below 60 for post {post_id}. Skipping.")
-            return {"statusCode": 200, "body": "All drafts rejected"}
+    if prior_draft:
+        return save_revised_draft(post_id, draft_index, prior_draft, validated_drafts, cache_key)
 
-        # 通知Lambdaを呼び出し
-        notification_payload = {
-            "post_id": post_id,
-            "original_text": original_text,
-            "author": author,
-            "drafts": go_drafts,
-            "trend_keywords_available": trend_keywords[:10],
-        }
+    # 60点未満の案は除外
+    go_drafts = [d for d in validated_drafts if d["total_score"] >= 60]
 
-        lambda_client.invoke(
-            FunctionName="qr-notify",
-            InvocationType="Event",  # 非同期
-            Payload=json.dumps(notification_payload, ensure_ascii=False).encode("utf-8"),
-        )
+    if not go_drafts:
+        print(f"All drafts scored below 60 for post {post_id}. Skipping.")
+        return "rejected"
+
+    # 原稿は生成段階で1度だけ構造化して保存し、通知・投稿段階はpost_idで参照する
+    update_expression = (
+        "SET original_text = :o, author = :a, author_profile = :p, #m = :m, "
+        "drafts = :d, generated_at = :g, generation_key = :k, "
+        "notification_sent = :f, notification_messages = :z"
+    )
+    values = {
+        ":o": original_text,
+        ":a": author,
+        ":p": author_profile,
+        ":m": mode,
+        ":d": [compact_draft(d) for d in go_drafts],
+        ":g": datetime.utcnow().isoformat(),
+        ":k": cache_key,
+        # 新しい原稿の通知は先頭のメッセージから送り直す
+        ":f": False,
+        ":z": 0,
+    }
+    # qr-monitor が近似重複として flag したポストは通知で判別できるように残す
+    near_duplicate_of = message.get("near_duplicate_of")
+    if near_duplicate_of:
+        update_expression += ", near_duplicate_of = :n"
+        values[":n"] = near_duplicate_of
+    TABLE_PROCESSED.update_item(
+        Key={"post_id": post_id},
+        UpdateExpression=update_expression,
+        ExpressionAttributeNames={"#m": "mode"},
+        ExpressionAttributeValues=values,
+    )
+
+    # 通知Lambdaを呼び出し
+    invoke_notify(post_id)
+
+    print(f"Notification sent for post {post_id} with {len(go_drafts)} drafts")
+    return "notified"
+
+
+def invoke_notify(post_id: str) -> None:
+    """通知Lambdaを非同期で呼び出す（原稿はpost_idで参照させる）"""
+    lambda_client.invoke(
+        FunctionName="qr-notify",
+        InvocationType="Event",  # 非同期
+        Payload=json.dumps({"post_id": post_id}).encode("utf-8"),
+    )
 
-        print(f"Notification sent for post {post_id} with {len(go_drafts)} drafts")
 
-    return {"statusCode": 200, "body": "Processing complete"}
+def save_revised_draft(
+    post_id: str, draft_index: int, prior_draft: dict, validated_drafts: list[dict], cache_key: str,
+) -> str:
+    """修正した1案を保存済みの drafts の該当位置に差し替えて再通知"""
+    if not validated_drafts:
+        raise ValueError(f"Revision returned no draft for post {post_id}")
+
+    # ユーザーが明示的に修正を求めた案なので、スコアによる除外はしない
+    revised = validated_drafts[0]
+    # 案の型（リスペクト型/逆説型/発展型）は修正しても変わらないため、モデルの出力ではなく修正前の型を使う
+    if prior_draft.get("type"):
+        revised = {**revised, "type": prior_draft["type"]}
+    TABLE_PROCESSED.update_item(
+        Key={"post_id": post_id},
+        UpdateExpression=(
+            f"SET drafts[{int(draft_index)}] = :d, revised_at = :r, generation_key = :k, "
+            "notification_sent = :f, notification_messages = :z"
+        ),
+        ConditionExpression="size(drafts) > :i",
+        ExpressionAttributeValues={
+            ":d": compact_draft(revised),
+            ":r": datetime.utcnow().isoformat(),
+            ":i": int(draft_index),
+            ":k": cache_key,
+            # 差し替え後の原稿は先頭のメッセージから通知し直す
+            ":f": False,
+            ":z": 0,
+        },
+    )
+
+    invoke_notify(post_id)
+
+    print(f"Revised draft {draft_index} for post {post_id} (score: {revised['total_score']})")
+    return "revised"
+
+
+@instrumented_handler("qr-generate")
+def lambda_handler(event, context):
+    """SQSトリガー: 新規ポストに対して3案生成+校正+チェック
+
+    バッチ内のレコードを並列処理し、失敗したレコードだけを
+    batchItemFailures で返す（ReportBatchItemFailures 有効化が前提）。
+    """
+    records = event.get("Records", [])
+    if not records:
+        return {"batchItemFailures": []}
+
+    # トレンドKW取得（バッチ内で共有）
+    trend_keywords = get_trend_keywords()
+
+    def handle(record: dict) -> str:
+        return process_post(json.loads(record["body"]), trend_keywords)
+
+    failures = []
+    workers = max(1, min(GENERATE_CONCURRENCY, len(records)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(handle, record): record for record in records}
+        for future in as_completed(futures):
+            record = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Record {record.get('messageId')} failed: {e}")
+                failures.append({"itemIdentifier": record["messageId"]})
+
+    print(f"Processed {len(records)} records ({len(failures)} failed)")
+    return {"batchItemFailures": failures}
@@ -2,124 +2,509 @@
 qr-monitor: X APIタイムライン監視 Lambda
 トリガー: EventBridge (5分間隔)
 役割: 15アカウントの新規ポストを検出し、SQSに送信
+投稿頻度・エンゲージメントの高いアカウントは毎サイクル、静かなアカウントは間隔を空けてポーリングする（next_poll_at）
 """
 
+import hashlib
 import json
+import math
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
 import tweepy
 from config import (
-    get_x_credentials,
+    call_with_reauth,
+    get_x_client,
     get_monitored_accounts,
-    is_post_processed,
-    mark_post_processed,
-    sqs,
+    filter_new_post_ids,
+    mark_posts_processed,
+    send_messages_batch,
     SQS_NEW_POST_QUEUE,
+    MONITOR_CONCURRENCY,
+    MONITOR_MAX_PAGES,
+    MONITOR_CYCLE_MINUTES,
+    MONITOR_MAX_BACKOFF,
+    MONITOR_HOT_RATIO,
+    MONITOR_EWMA_ALPHA,
+    MONITOR_STATE_HEARTBEAT_MINUTES,
+    NEAR_DUP_MAX_DISTANCE,
+    NEAR_DUP_ACTION,
+    NEAR_DUP_WINDOW_DAYS,
+    NEAR_DUP_MAX_PER_ACCOUNT,
+    NEAR_DUP_MIN_CHARS,
+    update_account_state,
+    x_rate_budget,
+    XBudget,
+    instrumented_handler,
+    trace_stage,
+    traced,
 )
 
 
-def get_x_client() -> tweepy.Client:
-    """X API v2クライアントを作成"""
-    creds = get_x_credentials()
-    return tweepy.Client(
-        consumer_key=creds["api_key"],
-        consumer_secret=creds["api_secret"],
-        access_token=creds["access_token"],
-        access_token_secret=creds["access_secret"],
-    )
+def _to_tweet_dict(tweet) -> dict:
+    return {
+        "id": str(tweet.id),
+        "text": tweet.text,
+        "created_at": tweet.created_at.isoformat() if tweet.created_at else "",
+        "metrics": {
+            "like_count": tweet.public_metrics.get("like_count", 0),
+            "retweet_count": tweet.public_metrics.get("retweet_count", 0),
+            "reply_count": tweet.public_metrics.get("reply_count", 0),
+            "bookmark_count": tweet.public_metrics.get("bookmark_count", 0),
+            "impression_count": tweet.public_metrics.get("impression_count", 0),
+        } if tweet.public_metrics else {},
+    }
 
 
-def fetch_recent_tweets(client: tweepy.Client, user_id: str, max_results: int = 10) -> list[dict]:
-    """ユーザーの最新ツイートを取得"""
-    try:
-        response = client.get_users_tweets(
-            id=user_id,
-            max_results=max_results,
-            tweet_fields=["created_at", "public_metrics", "text"],
-            exclude=["retweets", "replies"],
-        )
-        if response.data is None:
-            return []
+@traced("fetch_recent_tweets")
+def fetch_recent_tweets(
+    user_id: str,
+    max_results: int = 10,
+    since_id: str | None = None,
+    max_pages: int = MONITOR_MAX_PAGES,
+    budget: XBudget | None = None,
+) -> list[dict] | None:
+    """ユーザーの最新ツイートを取得
 
+    since_id 指定時はそれより新しいツイートのみを、ページングしながら取得する。
+    budget 指定時は1ページごとに確保済みの枠を消費する。
+    途中で失敗した場合は取りこぼしを防ぐため None を返す（ウォーターマークもポーリング間隔も変えない）。
+    """
+    try:
         tweets = []
-        for tweet in response.data:
-            tweets.append({
-                "id": str(tweet.id),
-                "text": tweet.text,
-                "created_at": tweet.created_at.isoformat() if tweet.created_at else "",
-                "metrics": {
-                    "like_count": tweet.public_metrics.get("like_count", 0),
-                    "retweet_count": tweet.public_metrics.get("retweet_count", 0),
-                    "reply_count": tweet.public_metrics.get("reply_count", 0),
-                    "bookmark_count": tweet.public_metrics.get("bookmark_count", 0),
-                    "impression_count": tweet.public_metrics.get("impression_count", 0),
-                } if tweet.public_metrics else {},
-            })
+        pagination_token = None
+        # 初回（ウォーターマーク無し）は最新1ページのみ
+        pages = max_pages if since_id else 1
+
+        for _ in range(pages):
+            if budget is not None and not budget.take():
+                print(f"X API budget exhausted while fetching user {user_id}")
+                return None
+            params = {
+                "id": user_id,
+                "max_results": max_results,
+                "tweet_fields": ["created_at", "public_metrics", "text"],
+                "exclude": ["retweets", "replies"],
+            }
+            if since_id:
+                params["since_id"] = since_id
+            if pagination_token:
+                params["pagination_token"] = pagination_token
+
+            with trace_stage("x.get_users_tweets"):
+                response = call_with_reauth(get_x_client, lambda client: client.get_users_tweets(**params))
+            if response.data:
+                tweets.extend(_to_tweet_dict(tweet) for tweet in response.data)
+
+            pagination_token = (response.meta or {}).get("next_token")
+            if not pagination_token:
+                break
+
         return tweets
     except tweepy.TweepyException as e:
         print(f"Error fetching tweets for user {user_id}: {e}")
+        return None
+
+
+def newest_tweet_id(tweets: list[dict]) -> str | None:
+    """ツイートIDの最大値（数値比較）を返す"""
+    if not tweets:
+        return None
+    return max((tweet["id"] for tweet in tweets), key=int)
+
+
+def fetch_accounts_tweets(
+    accounts: list[dict],
+    max_workers: int = MONITOR_CONCURRENCY,
+    budget: XBudget | None = None,
+) -> list[tuple[dict, list[dict] | None]]:
+    """複数アカウントのタイムラインを並列取得（1アカウントの失敗は他に影響させない、失敗時は None）"""
+    def fetch(account: dict) -> list[dict] | None:
+        try:
+            return fetch_recent_tweets(
+                account["x_user_id"],
+                since_id=account.get("last_seen_tweet_id") or None,
+                budget=budget,
+            )
+        except Exception as e:
+            print(f"Unexpected error fetching tweets for {account['account_id']}: {e}")
+            return None
+
+    if not accounts:
         return []
 
+    workers = max(1, min(max_workers, len(accounts)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map は入力順を保持する
+        return list(zip(accounts, executor.map(fetch, accounts)))
+
+
+# ──────────────────────────────────────
+# 適応ポーリング（投稿頻度・エンゲージメントで優先度付け）
+# ──────────────────────────────────────
+
+ENGAGEMENT_METRICS = ("like_count", "retweet_count", "reply_count", "bookmark_count")
+
+
+def poll_priority(account: dict) -> float:
+    """引用機会の見込み（1時間あたり投稿数 × 平均エンゲージメントの対数）"""
+    post_rate = float(account.get("post_rate", 0))
+    avg_engagement = float(account.get("avg_engagement", 0))
+    return post_rate * math.log1p(avg_engagement)
+
+
+def is_poll_due(account: dict, now: datetime) -> bool:
+    """next_poll_at を迎えているか"""
+    # EventBridgeの起動時刻の揺らぎで1サイクル遅れないよう1分の猶予を持たせる
+    return account.get("next_poll_at", "") <= (now + timedelta(minutes=1)).isoformat()
+
+
+def is_heartbeat_due(account: dict, now: datetime) -> bool:
+    """状態に変化が無くても書き込むべき時刻（前回の書き込みから一定時間経過）か"""
+    last_polled_at = account.get("last_polled_at")
+    return not last_polled_at or (
+        now - datetime.fromisoformat(last_polled_at) >= timedelta(minutes=MONITOR_STATE_HEARTBEAT_MINUTES)
+    )
+
+
+def select_scheduled_accounts(accounts: list[dict], now: datetime) -> tuple[list[dict], list[dict]]:
+    """今回ポーリングするアカウントを優先度順に選ぶ
+
+    優先度上位（MONITOR_HOT_RATIO）は毎サイクル、それ以外は next_poll_at を迎えたものだけ。
+    (ポーリング対象, 今回は見送るアカウント) を返す。
+    """
+    ordered = sorted(
+        accounts,
+        key=lambda account: (-poll_priority(account), account.get("last_polled_at", "")),
+    )
+    hot_count = math.ceil(len(ordered) * MONITOR_HOT_RATIO)
+    hot_ids = {
+        account["account_id"]
+        for account in ordered[:hot_count]
+        if poll_priority(account) > 0
+    }
+    due, skipped = [], []
+    for account in ordered:
+        if account["account_id"] in hot_ids or is_poll_due(account, now):
+            due.append(account)
+        else:
+            skipped.append(account)
+    return due, skipped
+
+
+def _ewma(previous, observed: float) -> Decimal:
+    value = observed if previous is None else (
+        MONITOR_EWMA_ALPHA * observed + (1 - MONITOR_EWMA_ALPHA) * float(previous)
+    )
+    # DynamoDBはfloatを受け付けないためDecimalで保存する
+    return Decimal(str(round(value, 4)))
+
+
+def observe_post_rate(account: dict, tweets: list[dict], now: datetime) -> float | None:
+    """今回の取得結果から1時間あたりの投稿数を観測する
+
+    last_polled_at は状態を書き込んだ時刻なので、書き込みを省いたポーリングの分も1つの観測にまとまる。
+    """
+    last_polled_at = account.get("last_polled_at")
+    if account.get("last_seen_tweet_id") and last_polled_at:
+        hours = (now - datetime.fromisoformat(last_polled_at)).total_seconds() / 3600
+        return len(tweets) / hours if hours > 0 else None
+
+    # 初回は最新ページの投稿間隔から見積もる
+    created = sorted(tweet["created_at"] for tweet in tweets if tweet["created_at"])
+    if len(created) < 2:
+        return None
+    hours = (
+        datetime.fromisoformat(created[-1]) - datetime.fromisoformat(created[0])
+    ).total_seconds() / 3600
+    return (len(created) - 1) / hours if hours > 0 else None
+
+
+def next_poll_state(account: dict, tweets: list[dict], now: datetime) -> dict:
+    """投稿頻度・平均エンゲージメントを更新し、次回ポーリング時刻を決める
+
+    新規ポストがあれば毎サイクルに戻し、無ければ間隔を倍にする（上限 2^MONITOR_MAX_BACKOFF サイクル）。
+    保存済みの値から変わる項目だけを返す（空なら書き込み不要）。
+    """
+    state = {}
+    # 新規ポストが無い間は観測を次回に持ち越し、ハートビートで0件の期間としてまとめて反映する
+    if tweets or is_heartbeat_due(account, now):
+        post_rate = observe_post_rate(account, tweets, now)
+        if post_rate is not None:
+            state["post_rate"] = _ewma(account.get("post_rate"), post_rate)
+
+    engagements = [
+        sum(tweet["metrics"].get(name, 0) for name in ENGAGEMENT_METRICS)
+        for tweet in tweets
+        if tweet["metrics"]
+    ]
+    if engagements:
+        state["avg_engagement"] = _ewma(
+            account.get("avg_engagement"), sum(engagements) / len(engagements),
+        )
+
+    # 優先度上位として予定より早くポーリングし、何も無かった場合は予定を変えない
+    if tweets or is_poll_due(account, now):
+        backoff = 0 if tweets else min(int(account.get("poll_backoff", 0)) + 1, MONITOR_MAX_BACKOFF)
+        state["poll_backoff"] = backoff
+        state["next_poll_at"] = (now + timedelta(minutes=MONITOR_CYCLE_MINUTES * 2 ** backoff)).isoformat()
+
+    return {name: value for name, value in state.items() if account.get(name) != value}
+
+
+def poll_cost(account: dict) -> int:
+    """1アカウントのポーリングで最大何回 users_tweets を呼ぶか"""
+    return MONITOR_MAX_PAGES if account.get("last_seen_tweet_id") else 1
+
+
+def select_poll_targets(accounts: list[dict], budget: XBudget) -> tuple[list[dict], list[dict]]:
+    """X APIの残り回数に収まるアカウントだけを選び、最大ページ数分の枠を budget に確保する
+
+    accounts は優先度順。(今回ポーリングするアカウント, 次回以降に回すアカウント) を返す。
+    使わなかったページ分は呼び出し側で budget.release() して返却する。
+    """
+    available = x_rate_budget(budget.endpoint, budget.priority)
+    targets, deferred = accounts, []
+    if available is not None:
+        targets = []
+        for i, account in enumerate(accounts):
+            if poll_cost(account) > available:
+                deferred = accounts[i:]
+                break
+            available -= poll_cost(account)
+            targets.append(account)
+    if targets and not budget.reserve(sum(poll_cost(account) for account in targets)):
+        return [], accounts
+    return targets, deferred
+
+
+# ──────────────────────────────────────
+# 近似重複検出（文字n-gramのSimHash、日本語は分かち書き不要）
+# ──────────────────────────────────────
+
+URL_PATTERN = re.compile(r"https?://\S+")
+
+
+def normalize_for_simhash(text: str) -> str:
+    """URL・空白・記号ゆれを除いた比較用テキスト"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = URL_PATTERN.sub("", text)
+    return "".join(ch for ch in text if ch.isalnum())
+
+
+def simhash(text: str, n: int = 3) -> int | None:
+    """64bit SimHash（短すぎる本文はNone）"""
+    normalized = normalize_for_simhash(text)
+    if len(normalized) < NEAR_DUP_MIN_CHARS:
+        return None
+    weights = [0] * 64
+    for i in range(len(normalized) - n + 1):
+        digest = hashlib.blake2b(normalized[i:i + n].encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "big")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+class NearDuplicateIndex:
+    """直近に処理したポストのフィンガープリント索引"""
+
+    def __init__(self, max_distance: int = NEAR_DUP_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.entries: list[tuple[int, str]] = []
+
+    def add(self, fingerprint: int, post_id: str) -> None:
+        self.entries.append((fingerprint, post_id))
+
+    def find(self, fingerprint: int, post_id: str) -> str | None:
+        """しきい値以内の既存ポストIDを返す（同一IDは除外）"""
+        for other, other_id in self.entries:
+            if other_id != post_id and (fingerprint ^ other).bit_count() <= self.max_distance:
+                return other_id
+        return None
+
+
+def load_near_duplicate_index(accounts: list[dict], cutoff: str) -> NearDuplicateIndex:
+    """全アカウントの保存済みフィンガープリントから索引を構築"""
+    index = NearDuplicateIndex()
+    for account in accounts:
+        for entry in account.get("recent_fingerprints", []):
+            if entry.get("seen_at", "") >= cutoff:
+                index.add(int(entry["simhash"], 16), entry["post_id"])
+    return index
+
+
+def merge_fingerprints(existing: list[dict], new: list[dict], cutoff: str) -> list[dict]:
+    """保存期間内かつ上限件数までの新しい順リスト"""
+    merged = [entry for entry in new + existing if entry.get("seen_at", "") >= cutoff]
+    return merged[:NEAR_DUP_MAX_PER_ACCOUNT]
+
+
+def build_post_message(account: dict, tweet: dict) -> dict:
+    """SQSに送信する新規ポストメッセージを成形"""
+    return {
+        "post_id": tweet["id"],
+        "text": tweet["text"],
+        "author": account["account_id"],
+        "author_profile": {
+            "account_id": account.get("account_id", ""),
+            "primary_theme": account.get("primary_theme", ""),
+            "thinking_pattern": account.get("thinking_pattern", ""),
+            "vocabulary_features": account.get("vocabulary_features", ""),
+            "hook_style": account.get("hook_style", ""),
+            "quote_angle": account.get("quote_angle", ""),
+            "best_quote_type": account.get("best_quote_type", ""),
+        },
+        "metrics": tweet["metrics"],
+        "created_at": tweet["created_at"],
+        "mode": "normal",  # デフォルト通常モード
+    }
 
+
+@instrumented_handler("qr-monitor")
 def lambda_handler(event, context):
     """メインハンドラー: 全監視アカウントの新規ポストを検出"""
-    client = get_x_client()
     accounts = get_monitored_accounts()
-    new_posts_count = 0
+    now = datetime.utcnow()
 
     print(f"Monitoring {len(accounts)} accounts...")
 
+    targets = []
     for account in accounts:
-        account_id = account["account_id"]
-        user_id = account.get("x_user_id", "")
+        if not account.get("x_user_id", ""):
+            print(f"Skipping {account['account_id']}: no x_user_id configured")
+            continue
+        targets.append(account)
+
+    # 優先度上位と次回ポーリング時刻を迎えたアカウントだけを対象にする
+    targets, not_due = select_scheduled_accounts(targets, now)
+
+    # レート制限の残りが少なければ優先度の低いアカウントを次回に回す
+    budget = XBudget("users_tweets", "normal")
+    targets, deferred = select_poll_targets(targets, budget)
+    if deferred:
+        print(f"X API budget low: polling {len(targets)} accounts, deferring {len(deferred)}")
 
-        if not user_id:
-            print(f"Skipping {account_id}: no x_user_id configured")
+    # 全アカウントのツイートを並列収集
+    fetched = fetch_accounts_tweets(targets, budget=budget)
+    # 追加ページが無かった分の枠を返却する
+    budget.release()
+    candidates = [(account, tweet) for account, tweets in fetched for tweet in tweets or []]
+
+    # 処理済みチェック（1サイクル分をまとめて照会）
+    new_ids = filter_new_post_ids([tweet["id"] for _, tweet in candidates])
+
+    new_posts = []
+    for account, tweet in candidates:
+        post_id = tweet["id"]
+        if post_id not in new_ids:
             continue
+        # 同一サイクル内の重複も除外
+        new_ids.discard(post_id)
 
-        tweets = fetch_recent_tweets(client, user_id)
-
-        for tweet in tweets:
-            post_id = tweet["id"]
-
-            # 処理済みチェック
-            if is_post_processed(post_id):
-                continue
-
-            # 新規ポスト発見
-            print(f"New post detected: {account_id} - {post_id}")
-
-            # SQSに送信
-            message = {
-                "post_id": post_id,
-                "text": tweet["text"],
-                "author": account_id,
-                "author_profile": {
-                    "account_id": account.get("account_id", ""),
-                    "primary_theme": account.get("primary_theme", ""),
-                    "thinking_pattern": account.get("thinking_pattern", ""),
-                    "vocabulary_features": account.get("vocabulary_features", ""),
-                    "hook_style": account.get("hook_style", ""),
-                    "quote_angle": account.get("quote_angle", ""),
-                    "best_quote_type": account.get("best_quote_type", ""),
-                },
-                "metrics": tweet["metrics"],
-                "created_at": tweet["created_at"],
-                "mode": "normal",  # デフォルト通常モード
-            }
+        # 新規ポスト発見
+        print(f"New post detected: {account['account_id']} - {post_id}")
+        new_posts.append((account, tweet))
+
+    # 近似重複チェック（直近に処理したポスト + 同一サイクル内）
+    cutoff = (now - timedelta(days=NEAR_DUP_WINDOW_DAYS)).isoformat()
+    index = load_near_duplicate_index(accounts, cutoff)
+    fingerprints = {}
+    messages = []
+    suppressed = []
+    for account, tweet in new_posts:
+        post_id = tweet["id"]
+        message = build_post_message(account, tweet)
+        fingerprint = simhash(tweet["text"])
+        if fingerprint is not None:
+            fingerprints[post_id] = fingerprint
+            duplicate_of = index.find(fingerprint, post_id)
+            index.add(fingerprint, post_id)
+            if duplicate_of:
+                print(f"Near-duplicate: {post_id} ~ {duplicate_of} ({NEAR_DUP_ACTION})")
+                if NEAR_DUP_ACTION == "suppress":
+                    suppressed.append((post_id, account["account_id"]))
+                    continue
+                message["near_duplicate_of"] = duplicate_of
+        messages.append((post_id, json.dumps(message, ensure_ascii=False)))
+
+    # SQSにまとめて送信
+    sent_ids, rejected_ids = send_messages_batch(SQS_NEW_POST_QUEUE, messages)
+
+    # SQSが受け付けたもの（と近似重複で抑制したもの）だけ処理済みとしてまとめてマーク
+    processed = [
+        (tweet["id"], account["account_id"])
+        for account, tweet in new_posts
+        if tweet["id"] in sent_ids
+    ]
+    if processed or suppressed:
+        mark_posts_processed(processed + suppressed)
+    # SQSが拒否したメッセージは再送しても通らないため、理由を付けて処理済みにしウォーターマークを進める
+    rejected = [
+        (tweet["id"], account["account_id"])
+        for account, tweet in new_posts
+        if tweet["id"] in rejected_ids
+    ]
+    if rejected:
+        mark_posts_processed(rejected, skip_reason="sqs_rejected")
+    new_posts_count = len(processed)
+    handled_ids = sent_ids | rejected_ids | {post_id for post_id, _ in suppressed}
 
-            sqs.send_message(
-                QueueUrl=SQS_NEW_POST_QUEUE,
-                MessageBody=json.dumps(message, ensure_ascii=False),
+    # 送信に失敗したポストがあるアカウントは次回再取得できるようウォーターマークを据え置く
+    failed_accounts = {
+        account["account_id"]
+        for account, tweet in new_posts
+        if tweet["id"] not in handled_ids
+    }
+    seen_at = now.isoformat()
+    state_writes = 0
+    for account, tweets in fetched:
+        account_id = account["account_id"]
+        if tweets is None:
+            # 取得失敗: 状態を変えず次サイクルで再試行する
+            continue
+        # 投稿頻度・エンゲージメントを学習し、次回ポーリング時刻を決める
+        # ウォーターマークを据え置いた後の再取得分は前回観測済みなので数えない
+        observed = int(account.get("last_observed_tweet_id") or 0)
+        state = next_poll_state(account, [tweet for tweet in tweets if int(tweet["id"]) > observed], now)
+
+        new_fingerprints = [
+            {"post_id": tweet["id"], "simhash": f"{fingerprints[tweet['id']]:016x}", "seen_at": seen_at}
+            for tweet in tweets
+            if tweet["id"] in handled_ids and tweet["id"] in fingerprints
+        ]
+        if new_fingerprints:
+            state["recent_fingerprints"] = merge_fingerprints(
+                account.get("recent_fingerprints", []), new_fingerprints, cutoff,
             )
 
-            # 処理済みとしてマーク
-            mark_post_processed(post_id, account_id)
-            new_posts_count += 1
+        newest = newest_tweet_id(tweets)
+        if account_id in failed_accounts:
+            print(f"Keeping watermark for {account_id}: SQS send failed")
+            if newest and int(newest) > observed:
+                state["last_observed_tweet_id"] = newest
+        elif newest and newest != account.get("last_seen_tweet_id"):
+            state["last_seen_tweet_id"] = newest
+
+        # 変化が無いアカウントはハートビートの間隔まで書き込まない
+        if state or is_heartbeat_due(account, now):
+            update_account_state(account_id, **state)
+            state_writes += 1
 
     return {
         "statusCode": 200,
         "body": json.dumps({
             "message": f"Monitoring complete. {new_posts_count} new posts detected.",
             "accounts_monitored": len(accounts),
+            "accounts_polled": len(targets),
+            "accounts_not_due": len(not_due),
+            "accounts_deferred": len(deferred),
             "new_posts": new_posts_count,
+            "near_duplicates_suppressed": len(suppressed),
+            "send_failures": len(messages) - new_posts_count - len(rejected),
+            "send_rejected": len(rejected),
+            "account_state_writes": state_writes,
         }),
     }
@@ -1,106 +1,225 @@
 """
 qr-notify: Discord通知 Lambda
 トリガー: qr-generateから非同期呼び出し
-役割: 検証済み3案をDiscord Webhookで通知
+役割: qr-generateが保存した検証済み3案をDiscord Webhookで通知
 """
 
-import json
-import requests
-from config import get_discord_webhook_url
-
-
-def format_notification(post_id: str, original_text: str, author: str, drafts: list[dict]) -> str:
-    """Discord通知メッセージを成形"""
-    lines = [
-        "━━━━━━━━━━━━━━━━━━━━━",
-        "**新規引用リポスト候補**",
-        "━━━━━━━━━━━━━━━━━━━━━",
-        "",
-        f"**元ポスト** ({author}):",
-        f"> {original_text[:300]}{'...' if len(original_text) > 300 else ''}",
-        "",
-        "━━━━━━━━━━━━━━━━━━━━━",
-    ]
+import time
+from config import (
+    get_discord_webhook_url,
+    get_http_session,
+    instrumented_handler,
+    record_retry,
+    traced,
+    TABLE_PROCESSED,
+)
+
+# send_webhook の結果: 送信済み / 4xxで拒否（再送しても通らない） / リトライを使い切った
+WEBHOOK_SENT = "sent"
+WEBHOOK_REJECTED = "rejected"
+WEBHOOK_FAILED = "failed"
+
+# Discord Webhookの制限
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBEDS_PER_MESSAGE = 10
+EMBED_TOTAL_LIMIT = 6000
+DISCORD_MAX_RETRIES = 5
+DISCORD_REQUEST_TIMEOUT = 5
+# 1回の呼び出しで再送待ちに使う上限（秒）。超える分は届いた位置から非同期呼び出しのリトライで再開する
+DISCORD_RETRY_BUDGET_SECONDS = 15
+# Lambdaのタイムアウト前に送信位置を保存するための余裕（秒）
+LAMBDA_TIMEOUT_MARGIN_SECONDS = 3
+EMBED_COLOR = 0x1D9BF0
+
+SEPARATOR = "━━━━━━━━━━━━━━━━━━━━━"
+
+
+def build_embeds(
+    original_text: str, author: str, drafts: list[dict], near_duplicate_of: str | None = None,
+) -> list[dict]:
+    """元ポスト + 各案をEmbedに成形"""
+    original = {
+        "title": f"元ポスト ({author})",
+        "description": f"{original_text[:300]}{'...' if len(original_text) > 300 else ''}",
+        "color": EMBED_COLOR,
+    }
+    if near_duplicate_of:
+        original["footer"] = {"text": f"近似重複の可能性: {near_duplicate_of}"}
+    embeds = [original]
 
     for i, draft in enumerate(drafts, 1):
         score = draft.get("total_score", 0)
         draft_type = draft.get("type", "")
         text = draft.get("text", "")
-        trend_kw = draft.get("trend_keywords", {})
-        kw_str = f" | KW: {', '.join(trend_kw.get('used_keywords', []))}" if trend_kw.get("has_trend_kw") else ""
-
-        lines.extend([
-            "",
-            f"**{i}. {draft_type}　{score}点**{kw_str}",
-            f"```",
-            text,
-            f"```",
-        ])
-
-    lines.extend([
-        "",
-        "━━━━━━━━━━━━━━━━━━━━━",
-        f"選択: `1` / `2` / `3`",
-        f"修正: `修正 {{修正指示}}`",
-        f"スキップ: `skip`",
-        f"━━━━━━━━━━━━━━━━━━━━━",
-    ])
+        used_keywords = draft.get("used_keywords", [])
+
+        # コードブロックの囲み分を差し引いて切り詰める
+        body = text[:EMBED_DESCRIPTION_LIMIT - 8]
+        embed = {
+            "title": f"{i}. {draft_type}　{score}点",
+            "description": f"```\n{body}\n```",
+            "color": EMBED_COLOR,
+        }
+        if used_keywords:
+            embed["footer"] = {"text": f"KW: {', '.join(used_keywords)}"}
+        embeds.append(embed)
+
+    return embeds
+
+
+def _embed_size(embed: dict) -> int:
+    return (
+        len(embed.get("title", ""))
+        + len(embed.get("description", ""))
+        + len(embed.get("footer", {}).get("text", ""))
+    )
 
-    return "\n".join(lines)
 
+def build_notification_messages(
+    original_text: str, author: str, drafts: list[dict], near_duplicate_of: str | None = None,
+) -> list[dict]:
+    """Webhookペイロードのリストを作成（通常は1メッセージに収まる）"""
+    header = "\n".join([SEPARATOR, "**新規引用リポスト候補**", SEPARATOR])
+    footer = "\n".join([
+        SEPARATOR,
+        "選択: `1` / `2` / `3`",
+        "修正: `修正 {修正指示}`",
+        "スキップ: `skip`",
+        SEPARATOR,
+    ])
 
+    # Embedの合計文字数・個数の上限に収まるようにメッセージへ詰める
+    groups = [[]]
+    size = 0
+    for embed in build_embeds(original_text, author, drafts, near_duplicate_of):
+        embed_size = _embed_size(embed)
+        if groups[-1] and (
+            size + embed_size > EMBED_TOTAL_LIMIT or len(groups[-1]) >= EMBEDS_PER_MESSAGE
+        ):
+            groups.append([])
+            size = 0
+        groups[-1].append(embed)
+        size += embed_size
+
+    messages = []
+    for i, embeds in enumerate(groups):
+        payload = {"username": "QuoteRepostBot", "embeds": embeds}
+        if i == 0:
+            payload["content"] = header
+        if i == len(groups) - 1:
+            payload["content"] = f"{payload.get('content', '')}\n{footer}".strip("\n")
+        messages.append(payload)
+    return messages
+
+
+def _wait(seconds: float, deadline: float) -> bool:
+    """deadline までに次の送信が収まる場合だけ待機する"""
+    if time.monotonic() + seconds + DISCORD_REQUEST_TIMEOUT > deadline:
+        return False
+    time.sleep(seconds)
+    return True
+
+
+@traced("discord.webhook")
+def send_webhook(session, webhook_url: str, payload: dict, deadline: float) -> str:
+    """Webhook送信（429/Retry-After とレート制限ヘッダーに従って待機・再送）
+
+    WEBHOOK_SENT / WEBHOOK_REJECTED / WEBHOOK_FAILED のいずれかを返す。
+    待機が deadline（time.monotonic の値）を越える場合は再送せず WEBHOOK_FAILED を返す。
+    """
+    for attempt in range(DISCORD_MAX_RETRIES + 1):
+        response = session.post(
+            webhook_url, params={"wait": "true"}, json=payload, timeout=DISCORD_REQUEST_TIMEOUT,
+        )
+
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after is None:
+                try:
+                    retry_after = response.json().get("retry_after", 1)
+                except ValueError:
+                    retry_after = 1
+            if attempt == DISCORD_MAX_RETRIES or not _wait(float(retry_after), deadline):
+                break
+            record_retry("discord.webhook")
+            continue
+
+        if response.status_code >= 500:
+            if attempt == DISCORD_MAX_RETRIES or not _wait(0.5 * (2 ** attempt), deadline):
+                break
+            record_retry("discord.webhook")
+            continue
+
+        if not response.ok:
+            print(f"Discord webhook rejected message: {response.status_code} {response.text[:200]}")
+            return WEBHOOK_REJECTED
+
+        # バケット残量が尽きていれば次の送信前にリセットまで待つ
+        # （待てない場合は次の送信が429になり、そこで打ち切る）
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            _wait(float(response.headers.get("X-RateLimit-Reset-After", 0)), deadline)
+        return WEBHOOK_SENT
+
+    print("Discord webhook failed after retries")
+    return WEBHOOK_FAILED
+
+
+@instrumented_handler("qr-notify")
 def lambda_handler(event, context):
-    """メインハンドラー: Discord Webhookで通知送信"""
+    """メインハンドラー: 保存済みの原稿をDiscord Webhookで通知送信"""
     post_id = event["post_id"]
-    original_text = event["original_text"]
-    author = event["author"]
-    drafts = event["drafts"]
 
-    webhook_url = get_discord_webhook_url()
-    message = format_notification(post_id, original_text, author, drafts)
-
-    # Discord Webhookは2000文字制限があるため、長い場合は分割
-    if len(message) <= 2000:
-        payload = {"content": message, "username": "QuoteRepostBot"}
-        response = requests.post(webhook_url, json=payload)
-    else:
-        # 分割送信
-        chunks = split_message(message, 2000)
-        for chunk in chunks:
-            payload = {"content": chunk, "username": "QuoteRepostBot"}
-            response = requests.post(webhook_url, json=payload)
-
-    # 投稿候補データをメタデータとして保存（後でpost関数が参照）
-    import boto3
-    dynamodb = boto3.resource("dynamodb", region_name="ap-northeast-1")
-    table = dynamodb.Table("QuoteRepost_ProcessedPosts")
-    table.update_item(
+    # 原稿はqr-generateが保存済み（ペイロードにはpost_idのみ）
+    response = TABLE_PROCESSED.get_item(
         Key={"post_id": post_id},
-        UpdateExpression="SET drafts = :d, notification_sent = :t",
-        ExpressionAttributeValues={
-            ":d": json.dumps(drafts, ensure_ascii=False),
-            ":t": True,
-        },
+        ProjectionExpression=(
+            "original_text, author, drafts, near_duplicate_of, notification_sent, notification_messages"
+        ),
     )
+    item = response.get("Item")
+    if not item or not item.get("drafts"):
+        print(f"No drafts stored for post {post_id}")
+        return {"statusCode": 404, "body": "Drafts not found"}
+    if item.get("notification_sent"):
+        print(f"Notification already sent for post {post_id}")
+        return {"statusCode": 200, "body": "Notification already sent"}
 
-    print(f"Notification sent for post {post_id}")
-    return {"statusCode": 200, "body": "Notification sent"}
-
+    webhook_url = get_discord_webhook_url()
+    session = get_http_session()
+    messages = build_notification_messages(
+        item.get("original_text", ""), item.get("author", ""), item["drafts"], item.get("near_duplicate_of"),
+    )
 
-def split_message(text: str, max_length: int) -> list[str]:
-    """メッセージを最大文字数で分割"""
-    chunks = []
-    lines = text.split("\n")
-    current_chunk = ""
+    # 再送待ちで関数のタイムアウトを越えないよう、待機できる期限を決めておく
+    deadline = time.monotonic() + DISCORD_RETRY_BUDGET_SECONDS
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000 - LAMBDA_TIMEOUT_MARGIN_SECONDS
+        deadline = min(deadline, time.monotonic() + remaining)
+
+    # 非同期呼び出しのリトライでは、前回までに届いたメッセージを送り直さない
+    delivered = int(item.get("notification_messages", 0))
+    result = WEBHOOK_SENT
+    for payload in messages[delivered:]:
+        result = send_webhook(session, webhook_url, payload, deadline)
+        if result != WEBHOOK_SENT:
+            break
+        delivered += 1
+    sent = delivered >= len(messages)
+
+    TABLE_PROCESSED.update_item(
+        Key={"post_id": post_id},
+        UpdateExpression="SET notification_sent = :t, notification_messages = :n, notification_rejected = :r",
+        ExpressionAttributeValues={":t": sent, ":n": delivered, ":r": result == WEBHOOK_REJECTED},
+    )
 
-    for line in lines:
-        if len(current_chunk) + len(line) + 1 > max_length:
-            chunks.append(current_chunk)
-            current_chunk = line
-        else:
-            current_chunk += "\n" + line if current_chunk else line
+    if result == WEBHOOK_REJECTED:
+        # 4xx（429以外）は再送しても通らないためリトライさせない
+        print(f"Discord rejected notification for post {post_id} ({delivered}/{len(messages)} messages)")
+        return {"statusCode": 400, "body": "Notification rejected by Discord"}
 
-    if current_chunk:
-        chunks.append(current_chunk)
+    if not sent:
+        # 非同期呼び出しのリトライに任せる（届いた分は notification_messages から再開）
+        raise RuntimeError(f"Discord delivery failed for post {post_id} ({delivered}/{len(messages)} messages)")
 
-    return chunks
+    print(f"Notification sent for post {post_id} ({len(messages)} messages)")
+    return {"statusCode": 200, "body": "Notification sent"}
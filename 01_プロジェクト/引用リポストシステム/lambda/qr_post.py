@@ -8,33 +8,24 @@ import json
 from datetime import datetime
 import tweepy
 from config import (
-    get_x_credentials,
+    call_with_reauth,
+    get_x_client,
+    acquire_x_budget,
+    x_rate_reset_at,
+    instrumented_handler,
     save_post_history,
+    traced,
     sqs,
     SQS_NEW_POST_QUEUE,
+    TABLE_PROCESSED as table_processed,
 )
-import boto3
 
-dynamodb = boto3.resource("dynamodb", region_name="ap-northeast-1")
-table_processed = dynamodb.Table("QuoteRepost_ProcessedPosts")
 
-
-def get_x_client_v2() -> tweepy.Client:
-    """投稿用X API v2クライアント"""
-    creds = get_x_credentials()
-    return tweepy.Client(
-        consumer_key=creds["api_key"],
-        consumer_secret=creds["api_secret"],
-        access_token=creds["access_token"],
-        access_token_secret=creds["access_secret"],
-    )
-
-
-def post_quote_repost(client: tweepy.Client, text: str, quoted_tweet_id: str) -> dict:
-    """X APIで引用リポストを投稿"""
-    response = client.create_tweet(
-        text=text,
-        quote_tweet_id=quoted_tweet_id,
+@traced("post_quote_repost")
+def post_quote_repost(text: str, quoted_tweet_id: str) -> dict:
+    """X APIで引用リポストを投稿（401の場合は送信されていないため認証情報を取り直して再試行）"""
+    response = call_with_reauth(
+        get_x_client, lambda client: client.create_tweet(text=text, quote_tweet_id=quoted_tweet_id),
     )
     return {
         "tweet_id": str(response.data["id"]),
@@ -42,6 +33,7 @@ def post_quote_repost(client: tweepy.Client, text: str, quoted_tweet_id: str) ->
     }
 
 
+@instrumented_handler("qr-post")
 def lambda_handler(event, context):
     """API Gatewayトリガー: 承認/修正/スキップ処理"""
 
@@ -56,21 +48,33 @@ def lambda_handler(event, context):
 
     # ─── 承認: X APIで投稿 ───
     if action == "approve":
-        # DynamoDBから原稿データを取得
-        response = table_processed.get_item(Key={"post_id": post_id})
+        if not isinstance(draft_index, int) or draft_index < 0:
+            return api_response(400, "Invalid draft index")
+
+        # DynamoDBから選択された原稿だけを取得
+        response = table_processed.get_item(
+            Key={"post_id": post_id},
+            ProjectionExpression=f"author, drafts[{draft_index}]",
+        )
         item = response.get("Item", {})
-        drafts = json.loads(item.get("drafts", "[]"))
+        drafts = item.get("drafts", [])
 
-        if not drafts or draft_index >= len(drafts):
+        if not drafts:
             return api_response(400, "Invalid draft index")
 
-        selected_draft = drafts[draft_index]
+        selected_draft = drafts[0]
         text = selected_draft.get("text", "")
 
+        # 承認投稿は予約枠も使えるが、ウィンドウを使い切っていれば呼び出さずにリセット時刻を返す
+        if not acquire_x_budget("create_tweet", 1, "high"):
+            return api_response(429, {
+                "message": "X API rate limit reached",
+                "reset_at": x_rate_reset_at("create_tweet"),
+            })
+
         # X API投稿
-        client = get_x_client_v2()
         try:
-            result = post_quote_repost(client, text, post_id)
+            result = post_quote_repost(text, post_id)
 
             # 投稿履歴を保存
             save_post_history({
@@ -81,7 +85,7 @@ def lambda_handler(event, context):
                 "quoted_author": item.get("author", ""),
                 "draft_type": selected_draft.get("type", ""),
                 "score": selected_draft.get("total_score", 0),
-                "trend_keywords_used": selected_draft.get("trend_keywords", {}).get("used_keywords", []),
+                "trend_keywords_used": selected_draft.get("used_keywords", []),
                 "engagement": {
                     "impressions": 0,
                     "likes": 0,
@@ -109,11 +113,22 @@ def lambda_handler(event, context):
             "post_id": post_id,
             "text": item.get("original_text", ""),
             "author": item.get("author", ""),
-            "author_profile": json.loads(item.get("author_profile", "{}")),
+            "author_profile": item.get("author_profile", {}),
             "mode": item.get("mode", "normal"),
             "revision_instruction": revision_instruction,
         }
 
+        # 案が指定されていればその1案だけを修正対象にする（未指定なら3案とも再生成）
+        drafts = item.get("drafts", [])
+        target_index = body.get("draft_index")
+        if isinstance(target_index, int) and 0 <= target_index < len(drafts):
+            prior = drafts[target_index]
+            revision_message["draft_index"] = target_index
+            revision_message["prior_draft"] = {
+                "type": prior.get("type", ""),
+                "text": prior.get("text", ""),
+            }
+
         sqs.send_message(
             QueueUrl=SQS_NEW_POST_QUEUE,
             MessageBody=json.dumps(revision_message, ensure_ascii=False),
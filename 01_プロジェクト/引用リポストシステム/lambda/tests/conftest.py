@@ -0,0 +1,21 @@
+"""
+テスト共通設定: lambda/ と benchmarks/ を import パスに追加する
+外部サービスは benchmarks/fakes.py の疑似実装を使う（boto3 は必要、tweepy は不要）
+"""
+
+import os
+import sys
+
+import pytest
+
+LAMBDA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LAMBDA_DIR)
+sys.path.insert(0, os.path.join(LAMBDA_DIR, "benchmarks"))
+
+import load_test  # noqa: E402
+
+
+@pytest.fixture
+def env():
+    """遅延なしの疑似サービスを差し替えた環境（監視アカウント5件）"""
+    return load_test.install_fakes(load_test.parse_args(["--accounts", "5", "--time-scale", "0"]))
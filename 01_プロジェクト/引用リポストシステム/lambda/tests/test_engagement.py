@@ -0,0 +1,72 @@
+"""qr_engagement の更新対象の絞り込みと部分更新のテスト"""
+
+import json
+from datetime import datetime, timedelta
+
+from fakes import config, qr_engagement
+
+
+def add_post(env, age: timedelta, **fields) -> tuple:
+    """age だけ前に投稿した履歴行を追加し、そのキーを返す"""
+    tweet = env.world._new_tweet("引用リポスト")
+    tweet.public_metrics.update(impression_count=1000, like_count=20)
+    posted_at = (datetime.utcnow() - age).isoformat()
+    config.save_post_history({"post_id": str(tweet.id), "posted_at": posted_at, "engagement": {}})
+    key = (str(tweet.id), posted_at)
+    row = env.tables["TABLE_HISTORY"].items[key]
+    row["next_refresh_at"] = (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+    row.update(fields)
+    return key
+
+
+def run_handler() -> dict:
+    response = qr_engagement.lambda_handler({}, None)
+    assert response["statusCode"] == 200
+    return json.loads(response["body"])
+
+
+def test_engagement_handler_smoke(env):
+    key = add_post(env, timedelta(hours=2))
+
+    body = run_handler()
+
+    assert body["due"] == 1
+    row = env.tables["TABLE_HISTORY"].items[key]
+    assert row["engagement"]["likes"] == 20
+    assert row["next_refresh_at"] > datetime.utcnow().isoformat()
+
+
+def test_unchanged_engagement_only_moves_schedule(env):
+    key = add_post(env, timedelta(hours=2), note="他の処理が書いた値")
+    run_handler()
+    row = env.tables["TABLE_HISTORY"].items[key]
+    first_update = row["last_updated"]
+    row["next_refresh_at"] = (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+
+    body = run_handler()
+
+    assert body["unchanged"] == 1
+    assert row["last_updated"] == first_update
+    assert row["note"] == "他の処理が書いた値"
+    assert row["next_refresh_at"] > datetime.utcnow().isoformat()
+
+
+def test_post_past_last_tier_is_frozen(env):
+    last_tier_hours = config.ENGAGEMENT_REFRESH_TIERS[-1][0]
+    key = add_post(env, timedelta(hours=last_tier_hours, minutes=30))
+
+    assert run_handler()["due"] == 1
+
+    row = env.tables["TABLE_HISTORY"].items[key]
+    assert row["refresh_frozen"] is True
+    assert "next_refresh_at" not in row
+
+
+def test_not_due_and_frozen_posts_are_not_fetched(env):
+    add_post(env, timedelta(hours=2), next_refresh_at=(datetime.utcnow() + timedelta(hours=1)).isoformat())
+    add_post(env, timedelta(days=3), refresh_frozen=True)
+
+    body = run_handler()
+
+    assert body["due"] == 0
+    assert env.faults.calls["x_api"] == 0
@@ -0,0 +1,121 @@
+"""qr_generate の出力スキーマ・ストリーム解析・採点・再配信・1案修正のテスト"""
+
+import json
+
+import pytest
+
+from fakes import qr_generate, qr_notify, qr_post
+
+
+def test_tool_schema_matches_prompt_output_format():
+    draft_schema = qr_generate.DRAFTS_TOOL["input_schema"]["properties"]["drafts"]["items"]
+    example = qr_generate.DRAFT_EXAMPLE
+
+    assert set(draft_schema["properties"]) == set(example)
+    score_schema = draft_schema["properties"]["score_self_assessment"]
+    assert score_schema["required"] == list(example["score_self_assessment"])
+
+
+def test_validate_draft_totals_only_known_score_keys():
+    scores = {key: 5 for key in qr_generate.SCORE_ASSESSMENT_KEYS}
+    scores["unexpected"] = 100
+    draft = {"type": "リスペクト型", "text": "毎朝5時に起きて30分だけ書く。", "score_self_assessment": scores}
+
+    result = qr_generate.validate_draft(draft, [])
+
+    expected = 5 * (len(qr_generate.SCORE_ASSESSMENT_KEYS) - 2) + result["score"]["specificity"]
+    assert result["total_score"] == expected
+
+
+def deliver_notifications(env) -> None:
+    """qr-generate が呼び出した qr-notify を順に実行する"""
+    while env.lam.invocations:
+        function_name, payload = env.lam.invocations.popleft()
+        assert function_name == "qr-notify"
+        qr_notify.lambda_handler(payload, None)
+
+
+def test_redelivered_record_is_not_notified_twice(env):
+    message = {
+        "post_id": "g1",
+        "text": "AIで副業を始めて3ヶ月、毎朝30分の習慣で月収5万円になった話",
+        "author": "@author",
+        "author_profile": {"primary_theme": "副業・AI活用"},
+    }
+    assert qr_generate.process_post(message, ["AI"]) == "notified"
+    deliver_notifications(env)
+    delivered = env.discord.delivered
+    assert delivered > 0
+
+    assert qr_generate.process_post(dict(message), ["AI"]) == "duplicate"
+    deliver_notifications(env)
+
+    assert env.discord.delivered == delivered
+    assert env.faults.calls["claude"] == 1
+
+
+def parse_stream(chunks: list[str]) -> qr_generate.DraftStreamParser:
+    parser = qr_generate.DraftStreamParser(lambda draft: None)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser
+
+
+def split_every(text: str, size: int) -> list[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_stream_parser_handles_escapes_split_across_chunks():
+    body = r'{"drafts": [{"type": "逆説型", "text": "引用\"}\\ ]{"}, {"type": "発展型", "text": "二案目"}]}'
+    emitted = []
+    parser = qr_generate.DraftStreamParser(emitted.append)
+
+    # 1文字ずつ渡し、バックスラッシュと続く文字が必ず別チャンクになるようにする
+    for chunk in split_every(body, 1):
+        parser.feed(chunk)
+
+    assert parser.closed
+    assert [draft["text"] for draft in emitted] == ['引用"}\\ ]{', "二案目"]
+
+
+def test_stream_parser_aborts_on_long_preamble():
+    with pytest.raises(ValueError, match="no drafts array"):
+        parse_stream(split_every("了解しました。" * 100, 50))
+
+
+def test_stream_parser_aborts_on_missing_fields():
+    with pytest.raises(ValueError, match="missing required fields"):
+        parse_stream(['{"drafts": [{"type": "逆説型"', ', "hook_type": "問い"}'])
+
+
+def test_stream_parser_rejects_non_object_element():
+    with pytest.raises(ValueError, match="string element"):
+        parse_stream(['{"drafts": [{"type": "逆説型", "text": "本文"}, "oo', 'ps"]}'])
+
+
+def test_revise_replaces_one_draft_and_keeps_its_type(env):
+    message = {
+        "post_id": "g2",
+        "text": "AIで副業を始めて3ヶ月、毎朝30分の習慣で月収5万円になった話",
+        "author": "@author",
+        "author_profile": {"primary_theme": "副業・AI活用"},
+    }
+    qr_generate.process_post(message, ["AI"])
+    deliver_notifications(env)
+    row = env.tables["TABLE_PROCESSED"].items[("g2",)]
+    before = [dict(draft) for draft in row["drafts"]]
+    assert len(before) >= 2 and row["notification_sent"] is True
+
+    body = {"action": "revise", "post_id": "g2", "draft_index": 1, "instruction": "もっと短く"}
+    assert qr_post.lambda_handler({"body": json.dumps(body)}, None)["statusCode"] == 200
+    revision = json.loads(env.sqs.queue.popleft()["body"])
+    assert revision["prior_draft"]["type"] == before[1]["type"]
+
+    assert qr_generate.process_post(revision, ["AI"]) == "revised"
+
+    assert row["drafts"][0] == before[0]
+    assert row["drafts"][1]["type"] == before[1]["type"]
+    assert row["drafts"][1]["text"] != before[1]["text"]
+    assert row["notification_sent"] is False
+    assert row["notification_messages"] == 0
+    assert list(env.lam.invocations) == [("qr-notify", {"post_id": "g2"})]
@@ -0,0 +1,24 @@
+"""負荷試験ハーネスを小さな規模で回し、全ハンドラーが通しで動くことを確認する"""
+
+import load_test
+
+
+def run(*argv: str) -> dict:
+    return load_test.run(load_test.parse_args(["--time-scale", "0", *argv]))
+
+
+def test_pipeline_runs_end_to_end():
+    report = run("--accounts", "10", "--cycles", "3", "--post-rate", "0.5", "--approve-rate", "1")
+
+    assert set(report["stages"]) == {"monitor", "generate", "notify", "post", "engagement"}
+    assert report["end_to_end_seconds"]["count"] > 0
+    assert report["posted"] > 0
+    assert report["dead_letters"] == 0
+    assert report["stages"]["engagement"]["items"] == report["posted"]
+
+
+def test_pipeline_survives_injected_errors():
+    report = run("--accounts", "10", "--cycles", "3", "--post-rate", "0.5", "--error-rate", "0.2")
+
+    assert report["injected_errors"]
+    assert report["stages"]["monitor"]["invocations"] == 3
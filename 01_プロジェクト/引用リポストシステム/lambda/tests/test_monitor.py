@@ -0,0 +1,71 @@
+"""qr_monitor の検出・SQS送信・ウォーターマーク管理のテスト"""
+
+import json
+from decimal import Decimal
+
+from fakes import config, qr_monitor
+
+
+def test_sender_fault_is_marked_processed_and_watermark_advances(env):
+    user_ids = [account["x_user_id"] for account in env.tables["TABLE_PROFILES"].items.values()]
+    env.world.post_rate = 1.0
+    env.world.advance(user_ids)
+    poison = env.world.timelines[user_ids[0]][-1]
+    env.sqs.poison.add(str(poison.id))
+
+    body = json.loads(qr_monitor.lambda_handler({}, None)["body"])
+
+    assert body["send_rejected"] == 1
+    assert body["send_failures"] == 0
+    record = env.tables["TABLE_PROCESSED"].items[(str(poison.id),)]
+    assert record["skip_reason"] == "sqs_rejected"
+    account = next(a for a in env.tables["TABLE_PROFILES"].items.values() if a["x_user_id"] == user_ids[0])
+    assert account["last_seen_tweet_id"] == str(poison.id)
+
+
+def run_handler() -> dict:
+    return json.loads(qr_monitor.lambda_handler({}, None)["body"])
+
+
+def test_quiet_hot_account_is_polled_without_state_write(env):
+    profiles = env.tables["TABLE_PROFILES"].items
+    run_handler()
+    hot = next(iter(profiles.values()))
+    hot["post_rate"] = Decimal("2.0")
+    hot["avg_engagement"] = Decimal("50")
+    config.invalidate_config_cache()
+    before = dict(hot)
+
+    body = run_handler()
+
+    assert body["accounts_polled"] == 1
+    assert body["account_state_writes"] == 0
+    assert hot == before
+
+
+def test_held_watermark_does_not_recount_tweets(env, monkeypatch):
+    user_ids = [account["x_user_id"] for account in env.tables["TABLE_PROFILES"].items.values()]
+    env.world.post_rate = 1.0
+    env.world.advance(user_ids)
+
+    # 1回目はSQS送信が全件失敗し、ウォーターマークを据え置く
+    send = qr_monitor.send_messages_batch
+    monkeypatch.setattr(qr_monitor, "send_messages_batch", lambda queue, messages: (set(), set()))
+    run_handler()
+    monkeypatch.setattr(qr_monitor, "send_messages_batch", send)
+    account = next(iter(env.tables["TABLE_PROFILES"].items.values()))
+    assert "last_seen_tweet_id" not in account
+    assert account["last_observed_tweet_id"]
+
+    observed = []
+    next_poll_state = qr_monitor.next_poll_state
+    monkeypatch.setattr(
+        qr_monitor, "next_poll_state",
+        lambda account, tweets, now: observed.append(tweets) or next_poll_state(account, tweets, now),
+    )
+    account["next_poll_at"] = ""
+    config.invalidate_config_cache()
+    body = run_handler()
+
+    assert body["new_posts"] >= 1
+    assert observed and all(tweets == [] for tweets in observed)
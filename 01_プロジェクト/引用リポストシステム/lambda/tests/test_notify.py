@@ -0,0 +1,90 @@
+"""qr_notify の再開送信と4xx拒否の扱いのテスト"""
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from fakes import qr_generate, qr_notify
+
+
+def add_drafts(env, post_id: str, count: int) -> dict:
+    """Embed上限を超えて複数メッセージに分かれる原稿を保存する"""
+    row = {
+        "post_id": post_id,
+        "original_text": "元ポスト",
+        "author": "@author",
+        "drafts": [{"type": "共感", "text": f"案{i}", "total_score": 80} for i in range(count)],
+        "notification_sent": False,
+        "notification_messages": 0,
+    }
+    env.tables["TABLE_PROCESSED"].items[(post_id,)] = row
+    return row
+
+
+@pytest.fixture
+def sleeps(monkeypatch) -> list[float]:
+    """send_webhook の待機を記録するだけにする"""
+    waited = []
+    # time モジュール自体は疑似サービスの遅延にも使うため、qr_notify の参照だけ差し替える
+    monkeypatch.setattr(qr_notify, "time", SimpleNamespace(sleep=waited.append, monotonic=time.monotonic))
+    return waited
+
+
+def test_retry_resumes_from_delivered_offset(env, sleeps):
+    row = add_drafts(env, "p1", 25)
+    total = len(qr_notify.build_notification_messages("元ポスト", "@author", row["drafts"]))
+    assert total == 3
+
+    # 2通目で5xxが続き、リトライを使い切る
+    env.discord.statuses = [200] + [500] * (qr_notify.DISCORD_MAX_RETRIES + 1)
+    with pytest.raises(RuntimeError):
+        qr_notify.lambda_handler({"post_id": "p1"}, None)
+    assert row["notification_messages"] == 1
+    assert row["notification_sent"] is False
+    assert len(sleeps) == qr_notify.DISCORD_MAX_RETRIES
+
+    delivered = env.discord.delivered
+    assert qr_notify.lambda_handler({"post_id": "p1"}, None)["statusCode"] == 200
+    assert env.discord.delivered - delivered == total - 1
+    assert row["notification_sent"] is True
+
+
+def test_retries_stop_before_lambda_timeout(env, sleeps):
+    row = add_drafts(env, "p4", 3)
+    env.discord.statuses = [500] * (qr_notify.DISCORD_MAX_RETRIES + 1)
+    context = SimpleNamespace(get_remaining_time_in_millis=lambda: 5000)
+
+    with pytest.raises(RuntimeError):
+        qr_notify.lambda_handler({"post_id": "p4"}, context)
+
+    # 残り5秒では再送待ちの後に送信が収まらないため、待たずに非同期リトライへ回す
+    assert sleeps == []
+    assert row["notification_messages"] == 0
+
+
+def test_client_error_is_not_retried(env):
+    row = add_drafts(env, "p2", 3)
+    env.discord.statuses = [400]
+
+    response = qr_notify.lambda_handler({"post_id": "p2"}, None)
+
+    assert response["statusCode"] == 400
+    assert row["notification_rejected"] is True
+    assert row["notification_sent"] is False
+
+
+def test_flagged_near_duplicate_reaches_discord(env):
+    message = {
+        "post_id": "p3",
+        "text": "AIで副業を始めて3ヶ月、毎朝30分の習慣で月収5万円になった話",
+        "author": "@author",
+        "author_profile": {"primary_theme": "副業・AI活用"},
+        "near_duplicate_of": "p0",
+    }
+    assert qr_generate.process_post(message, ["AI"]) == "notified"
+    assert env.tables["TABLE_PROCESSED"].items[("p3",)]["near_duplicate_of"] == "p0"
+
+    assert qr_notify.lambda_handler({"post_id": "p3"}, None)["statusCode"] == 200
+    original = env.discord.payloads[0]["embeds"][0]
+    assert "p0" in original["footer"]["text"]
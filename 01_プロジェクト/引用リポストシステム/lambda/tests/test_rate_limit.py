@@ -0,0 +1,54 @@
+"""X APIレート制限ガバナーのテスト"""
+
+import json
+import time
+from types import SimpleNamespace
+
+from fakes import config, qr_monitor
+
+
+def x_response(url: str, remaining: int, reset_at: int, method: str = "GET"):
+    return SimpleNamespace(
+        url=url,
+        request=SimpleNamespace(method=method),
+        headers={
+            "x-rate-limit-limit": "100",
+            "x-rate-limit-remaining": str(remaining),
+            "x-rate-limit-reset": str(reset_at),
+        },
+    )
+
+
+def test_monitor_reserves_pages_and_refunds_unused(env):
+    for account in env.tables["TABLE_PROFILES"].items.values():
+        account["last_seen_tweet_id"] = "1"
+    # 上限100・残り20、通常優先度の予約枠10 → 使えるのは10回（= 2アカウント × 最大5ページ）
+    env.tables["TABLE_RATE_LIMITS"].items[("users_tweets",)] = {
+        "endpoint": "users_tweets", "limit": 100, "remaining": 20, "reset_at": int(time.time()) + 600,
+    }
+
+    body = json.loads(qr_monitor.lambda_handler({}, None)["body"])
+
+    assert body["accounts_polled"] == 2
+    assert body["accounts_deferred"] == 3
+    # 各アカウント1ページだけ使い、残り4ページ分ずつ返却される
+    assert env.tables["TABLE_RATE_LIMITS"].items[("users_tweets",)]["remaining"] == 18
+
+
+def test_rate_limit_headers_are_written_once_per_endpoint(env):
+    table = env.tables["TABLE_RATE_LIMITS"]
+    reset_at = int(time.time()) + 600
+    for remaining in (50, 48, 49):
+        config._observe_x_rate_limit(x_response("https://api.x.com/2/users/1/tweets", remaining, reset_at))
+    config._observe_x_rate_limit(x_response("https://api.x.com/2/tweets", 9, reset_at, method="POST"))
+    # ヘッダーが壊れていても例外を外に出さない
+    config._observe_x_rate_limit(SimpleNamespace(headers=None))
+    assert not table.items
+
+    config.flush_x_rate_limits()
+
+    assert table.items[("users_tweets",)]["remaining"] == 48
+    assert table.items[("create_tweet",)]["remaining"] == 9
+    calls = env.faults.calls["dynamodb"]
+    config.flush_x_rate_limits()
+    assert env.faults.calls["dynamodb"] == calls
@@ -0,0 +1,44 @@
+"""シークレットのローテーション時（401）のクライアント再生成のテスト"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from fakes import config, qr_post
+
+
+class Unauthorized(Exception):
+    """tweepy.Unauthorized 相当（response.status_code が 401）"""
+
+    def __init__(self):
+        super().__init__("401 Unauthorized")
+        self.response = SimpleNamespace(status_code=401)
+
+
+class StaleClient:
+    def create_tweet(self, text, quote_tweet_id=None):
+        raise Unauthorized()
+
+
+def test_unauthorized_reloads_secrets_and_retries_once(env, monkeypatch):
+    config.get_secret("/quote-repost/x-api-key")
+    fresh = env.world.client()
+    clients = iter([StaleClient(), fresh])
+    monkeypatch.setattr(qr_post, "get_x_client", lambda: next(clients))
+
+    result = qr_post.post_quote_repost("本文", "123")
+
+    assert result["text"] == "本文"
+    assert config._secret_cache == {}
+
+
+def test_other_errors_are_not_retried(env):
+    calls = []
+
+    def fail(client):
+        calls.append(client)
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        config.call_with_reauth(lambda: env.world.client(), fail)
+    assert len(calls) == 1